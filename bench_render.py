@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''
+Compare the curses renderer and the ANSI renderer of tmux.py
+
+Each renderer draws the same frames in a pty: a full-screen workload where
+every line changes (scrolling output), and an incremental workload where one
+character is added per frame (typing).
+'''
+
+import argparse
+import curses
+import json
+import os
+import pty
+import select
+import sys
+import termios
+import time
+
+import tmux
+
+COLORS = (curses.COLOR_RED, curses.COLOR_GREEN, curses.COLOR_YELLOW, curses.COLOR_BLUE)
+
+
+def make_line(n, width):
+    '''A line with a few colored words'''
+    line = tmux.FormattedString()
+    for i in range(width // 10):
+        line += tmux.FormattedString('word%05d ' % (n + i), fg=COLORS[(n + i) % len(COLORS)])
+    return line.ljust(width, ' ')
+
+
+def full_screen_frames(height, width, count):
+    pool = [make_line(n, width) for n in range(count + height)]
+    for f in range(count):
+        yield pool[f:f + height], (height - 1, 0)
+
+
+def incremental_frames(height, width, count):
+    lines = [make_line(n, width) for n in range(height)]
+    prompt = tmux.FormattedString('$ ')
+
+    for f in range(count):
+        typed = prompt + tmux.FormattedString('x' * (f % (width - 3)))
+        lines[-1] = typed.ljust(width, ' ')
+        yield list(lines), (height - 1, len(typed))
+
+
+def draw_curses(win):
+    def draw(lines, cursor):
+        win.leaveok(1)
+        for y, line in enumerate(lines):
+            tmux.add_formatted_str(win, y, 0, line)
+        win.leaveok(0)
+        win.move(*cursor)
+        win.refresh()
+
+    return draw
+
+
+def run(screen, height, width, count, results):
+    curses.use_default_colors()
+
+    for workload, frames in (('full-screen', full_screen_frames),
+                             ('incremental', incremental_frames)):
+        for name in ('curses', 'ansi'):
+            if name == 'curses':
+                draw = draw_curses(curses.newwin(height, width, 0, 0))
+            else:
+                draw = tmux.AnsiRenderer(sys.stdout.fileno()).render
+
+            screen.clear()
+            screen.refresh()
+            all_frames = list(frames(height, width, count))
+
+            start = time.perf_counter()
+            for lines, cursor in all_frames:
+                draw(lines, cursor)
+            elapsed = time.perf_counter() - start
+
+            termios.tcdrain(sys.stdout.fileno())
+            os.write(results, (json.dumps([workload, name, elapsed]) + '\n').encode())
+
+
+def read_available(fd):
+    size = 0
+    while select.select([fd], [], [], 0)[0]:
+        try:
+            size += len(os.read(fd, 65536))
+        except OSError:
+            break
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the renderers of tmux.py')
+    parser.add_argument('-n', '--frames',
+                        help='Number of frames of each workload (default: 500)',
+                        type=int, default=500)
+    parser.add_argument('--size',
+                        help='Size of the terminal (default: 24x80)',
+                        default='24x80')
+
+    args = parser.parse_args()
+    height, width = map(int, args.size.split('x'))
+    results_r, results_w = os.pipe()
+    pid, fd = pty.fork()
+
+    if pid == 0: # child
+        os.close(results_r)
+        tmux.set_hw(sys.stdout.fileno(), height, width)
+        os.environ['TERM'] = os.environ.get('TERM', 'xterm')
+        curses.wrapper(run, height, width, args.frames, results_w)
+        os._exit(0)
+
+    os.close(results_w)
+    results = os.fdopen(results_r)
+    output_size = 0
+
+    print('%-12s %-8s %12s %12s' % ('workload', 'renderer', 'ms/frame', 'bytes/frame'))
+
+    while True:
+        ready = select.select([fd, results_r], [], [])[0]
+
+        if fd in ready:
+            output_size += read_available(fd)
+
+        if results_r in ready:
+            line = results.readline()
+            if not line:
+                break
+
+            output_size += read_available(fd)
+            workload, name, elapsed = json.loads(line)
+            print('%-12s %-8s %12.3f %12d' % (workload, name, elapsed * 1000 / args.frames,
+                                              output_size // args.frames))
+            output_size = 0
+
+    os.waitpid(pid, 0)
+    os.close(fd)
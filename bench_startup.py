@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+'''
+Measure the startup time of tmux.py, from exec to the first prompt of the shell
+'''
+
+import argparse
+import fcntl
+import os
+import pty
+import select
+import signal
+import statistics
+import struct
+import sys
+import termios
+import time
+
+PROMPT = 'pytmux-ready'
+
+
+def time_to_first_prompt(args, shell, height, width, timeout):
+    '''Run the command in a new pty and wait for the prompt on its output'''
+    env = dict(os.environ, SHELL=shell, PS1=PROMPT + '$ ', TERM=os.environ.get('TERM', 'xterm'))
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+
+    if pid == 0: # child
+        os.execve(args[0], args, env)
+
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('hhhh', height, width, 0, 0))
+    output = b''
+
+    try:
+        while PROMPT.encode() not in output:
+            remaining = start + timeout - time.perf_counter()
+            if remaining <= 0:
+                return None
+
+            if select.select([fd], [], [], remaining)[0]:
+                try:
+                    output += os.read(fd, 65536)
+                except OSError:
+                    return None
+
+        return time.perf_counter() - start
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the time to the first prompt of tmux.py')
+    parser.add_argument('-n', '--runs',
+                        help='Number of runs (default: 20)',
+                        type=int, default=20)
+    parser.add_argument('--shell',
+                        help='Shell launched by tmux.py, it must honor PS1 (default: /bin/sh)',
+                        default='/bin/sh')
+    parser.add_argument('--timeout',
+                        help='Timeout of a run, in seconds (default: 10)',
+                        type=float, default=10)
+    parser.add_argument('--size',
+                        help='Size of the terminal (default: 24x80)',
+                        default='24x80')
+
+    args = parser.parse_args()
+    height, width = map(int, args.size.split('x'))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmux.py')
+
+    times = []
+    for _ in range(args.runs):
+        t = time_to_first_prompt([sys.executable, script], args.shell, height, width, args.timeout)
+
+        if t is None:
+            print('error: no prompt after %.1fs' % args.timeout, file=sys.stderr)
+            exit(1)
+
+        times.append(t * 1000)
+
+    print('time to first prompt (%d runs): min %.1fms, median %.1fms, max %.1fms' % (
+        len(times), min(times), statistics.median(times), max(times)))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+'''
+Feed random and adversarial byte streams to ConsoleWindow.write
+
+Each stream is written in chunks of random sizes, like the reads of a pane.
+The emulation must not raise, must keep its invariants, and must stay within
+a time budget per byte and a memory budget.
+'''
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+
+import tmux
+
+FINAL_BYTES = 'ABCDGHIJKLMPXZdfghlmnrcq@$p~'
+BUDGET = 0.0005 # seconds per write(), smaller than a pane's to defer the writes often
+
+
+def random_bytes(rng, size):
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def random_sequence(rng):
+    '''A control sequence, often malformed'''
+    kind = rng.random()
+
+    if kind < 0.5: # CSI
+        params = ';'.join(str(rng.choice((0, 1, 2, rng.randint(0, 300), 10 ** rng.randint(3, 30))))
+                          for _ in range(rng.randint(0, 4)))
+        private = rng.choice(('', '', '?', '>'))
+        return '\x1b[%s%s%s' % (private, params, rng.choice(FINAL_BYTES))
+    elif kind < 0.6: # OSC
+        return '\x1b]%d;%s%s' % (rng.randint(0, 100), 'x' * rng.randint(0, 200),
+                                 rng.choice(('\a', '\x1b\\', '')))
+    elif kind < 0.7: # private modes
+        return '\x1b[?%d%s' % (rng.choice((1, 25, 47, 1047, 1049, 2004, 2026)), rng.choice('hl'))
+    else:
+        return '\x1b' + chr(rng.randint(0x20, 0x7e))
+
+
+def random_stream(rng, size):
+    '''Text, control characters and control sequences'''
+    parts = []
+    length = 0
+
+    while length < size:
+        kind = rng.random()
+
+        if kind < 0.4:
+            part = random_sequence(rng)
+        elif kind < 0.6:
+            part = ''.join(rng.choice('abc \t\r\n\b\a\x00\x7fé中\U0001f600')
+                           for _ in range(rng.randint(1, 20)))
+        else:
+            part = 'x' * rng.randint(1, 300)
+
+        part = part.encode('utf8')
+        parts.append(part)
+        length += len(part)
+
+    return b''.join(parts)
+
+
+# streams which used to hang or crash
+ADVERSARIAL = {
+    'delete-lines': b'\x1b[99999999M' * 1000,
+    'insert-lines': b'\x1b[99999999L' * 1000,
+    'erase-chars': b'\x1b[99999999X' * 1000,
+    'delete-chars': b'\x1b[99999999P' * 1000,
+    'huge-parameter': b'\x1b[' + b'9' * 10000 + b'A',
+    'huge-osc': b'\x1b]0;' + b'x' * 100000,
+    'osc-semicolons': b'\x1b]8;' + b';x' * 50 + b'\x1b\\' * 1000,
+    'shell-marks': b'\x1b]133;A\x07$ \x1b]133;C\x07\n' * 50000,
+    'escapes': b'\x1b' * 100000,
+    'unknown-sequences': b'\x1b[99z' * 20000,
+    'tabs': b'\t' * 100000,
+    'scroll-area': b'\x1b[2;3r' + b'\n' * 100000,
+    'alternate-screen': b'\x1b[?1049hx\x1b[?1049l' * 10000,
+    'long-line': b'x' * 1000000,
+    'split-utf8': '中'.encode('utf8') * 100000,
+}
+
+
+def check_invariants(console):
+    assert console.offset + console.cursor.y < len(console.lines)
+    assert len(console.lines) <= console.history_size
+    assert 0 <= console.cursor.y < console.height
+    assert 0 <= console.cursor.x <= console.width
+    assert all(len(line) == console.width for line in console.display_lines())
+
+
+def write(data, chunks, height, width, history_size):
+    '''Write the data like a pane, with a budget per write()'''
+    console = tmux.ConsoleWindow(height, width, 0, 0, history_size, headless=True)
+    console.reply_query = lambda s: None
+    rng = random.Random(chunks)
+    pos = 0
+
+    while pos < len(data) or not console.can_write():
+        if not console.can_write():
+            console.write('', BUDGET)
+            continue
+
+        size = rng.randint(1, 4096)
+        console.write(data[pos:pos + size], BUDGET)
+        pos += size
+
+    return console
+
+
+def run(data, chunks, height, width, history_size):
+    '''Write the data in random chunks, return the time and the memory peak
+
+    The memory is measured in a second pass, tracemalloc slows the emulation
+    down too much to time it at the same time.
+    '''
+    start = time.perf_counter()
+    console = write(data, chunks, height, width, history_size)
+    elapsed = time.perf_counter() - start
+    check_invariants(console)
+
+    tracemalloc.start()
+    write(data, chunks, height, width, history_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fuzz the emulation of tmux.py')
+    parser.add_argument('-n', '--streams',
+                        help='Number of random streams (default: 50)',
+                        type=int, default=50)
+    parser.add_argument('--stream-size',
+                        help='Size of the random streams, in bytes (default: 100000)',
+                        type=int, default=100000)
+    parser.add_argument('--seed',
+                        help='Seed of the random streams (default: random)',
+                        type=int, default=None)
+    parser.add_argument('--size',
+                        help='Size of the window (default: 24x80)',
+                        default='24x80')
+    parser.add_argument('--history',
+                        help='Size of the history (default: 200)',
+                        type=int, default=200)
+    parser.add_argument('--max-time',
+                        help='Maximum time per byte, in microseconds (default: 20)',
+                        type=float, default=20)
+    parser.add_argument('--max-memory',
+                        help='Maximum memory allocated at once, in MB (default: 64)',
+                        type=float, default=64)
+
+    args = parser.parse_args()
+    height, width = map(int, args.size.split('x'))
+    seed = args.seed if args.seed is not None else random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    print('seed %d' % seed)
+
+    streams = list(ADVERSARIAL.items())
+    for i in range(args.streams):
+        if i % 2:
+            streams.append(('random-bytes-%d' % i, random_bytes(rng, args.stream_size)))
+        else:
+            streams.append(('random-stream-%d' % i, random_stream(rng, args.stream_size)))
+
+    failures = 0
+    for name, data in streams:
+        try:
+            elapsed, peak = run(data, rng.getrandbits(32), height, width, args.history)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        else:
+            us_per_byte = elapsed * 1e6 / len(data)
+            print('%-22s %8d bytes %8.2fus/byte %8.1fMB' % (name, len(data), us_per_byte,
+                                                             peak / 1e6))
+
+            if us_per_byte > args.max_time:
+                error = 'too slow'
+            elif peak > args.max_memory * 1e6:
+                error = 'too much memory'
+            else:
+                continue
+
+        failures += 1
+        path = 'fuzz-failure-%d-%s.bin' % (seed, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        print('error: %s: %s (input saved in %s)' % (name, error, path), file=sys.stderr)
+
+    if failures:
+        exit(1)
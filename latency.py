@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+'''
+Measure the keystroke-to-screen latency of tmux.py, idle and under heavy output
+
+Each key is a distinct non-ascii glyph typed in the shell of the window: the
+latency is the time between writing the key and the glyph appearing in the
+output of tmux.py.
+'''
+
+import argparse
+import collections
+import fcntl
+import os
+import pty
+import select
+import signal
+import struct
+import sys
+import termios
+import time
+
+PROMPT = 'pytmux-ready'
+
+# glyphs of width 1 that do not appear in the banner nor in the background output
+GLYPHS = [chr(c) for c in range(0xc0, 0x180) if c not in (0xd7, 0xf7)]
+
+KILL_LINE = b'\x15' # ctrl-u, sent regularly to keep the line short
+KILL_LINE_EVERY = 16
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Harness:
+    def __init__(self, args, shell, height, width):
+        env = dict(os.environ, SHELL=shell, PS1=PROMPT + '$ ',
+                   TERM=os.environ.get('TERM', 'xterm'), LANG='C.UTF-8', LC_ALL='C.UTF-8')
+        self.pid, self.fd = pty.fork()
+
+        if self.pid == 0: # child
+            os.execve(args[0], args, env)
+
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack('hhhh', height, width, 0, 0))
+        self.output = bytearray()
+
+    def read(self, timeout):
+        '''Read the output of tmux.py, return False on timeout'''
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return False
+
+        try:
+            self.output += os.read(self.fd, 65536)
+        except OSError:
+            raise RuntimeError('tmux.py exited')
+
+        return True
+
+    def wait_for(self, data, timeout):
+        deadline = time.perf_counter() + timeout
+
+        while data not in self.output:
+            if not self.read(deadline - time.perf_counter()) and time.perf_counter() >= deadline:
+                raise RuntimeError('timeout waiting for %r' % data)
+
+        del self.output[:]
+
+    def type(self, data):
+        os.write(self.fd, data)
+
+    def measure(self, keys, rate, timeout):
+        '''Type keys at the given rate, return the latencies (in ms) and the number of lost keys'''
+        pending = collections.deque() # (glyph, time) in the order they were typed
+        latencies = []
+        lost = 0
+        sent = 0
+        next_send = time.perf_counter()
+        del self.output[:]
+
+        while sent < keys or pending:
+            now = time.perf_counter()
+
+            if sent < keys and now >= next_send:
+                if sent % KILL_LINE_EVERY == 0:
+                    self.type(KILL_LINE)
+
+                glyph = GLYPHS[sent % len(GLYPHS)].encode()
+                pending.append((glyph, time.perf_counter()))
+                self.type(glyph)
+                sent += 1
+                next_send += 1 / rate
+                continue
+
+            while pending and now - pending[0][1] > timeout:
+                pending.popleft()
+                lost += 1
+
+            deadline = next_send if sent < keys else now + timeout
+            self.read(deadline - now)
+            now = time.perf_counter()
+
+            # the glyphs are echoed in order
+            while pending:
+                glyph, t = pending[0]
+                pos = self.output.find(glyph)
+
+                if pos == -1:
+                    break
+
+                latencies.append((now - t) * 1000)
+                pending.popleft()
+                del self.output[:pos + len(glyph)]
+
+            # keep the tail, a glyph might be split between two reads
+            del self.output[:-4]
+
+        return latencies, lost
+
+    def close(self):
+        os.kill(self.pid, signal.SIGKILL)
+        os.waitpid(self.pid, 0)
+        os.close(self.fd)
+
+
+def report(name, latencies, lost):
+    if not latencies:
+        print('%-5s no key echoed, %d lost' % (name, lost))
+        return
+
+    print('%-5s %d keys: p50 %.1fms, p90 %.1fms, p99 %.1fms, max %.1fms, %d lost' % (
+        name, len(latencies), percentile(latencies, 50), percentile(latencies, 90),
+        percentile(latencies, 99), max(latencies), lost))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the keystroke-to-screen latency of tmux.py')
+    parser.add_argument('-n', '--keys',
+                        help='Number of keys typed in each phase (default: 200)',
+                        type=int, default=200)
+    parser.add_argument('--rate',
+                        help='Keys typed per second (default: 20)',
+                        type=float, default=20)
+    parser.add_argument('--shell',
+                        help='Shell launched by tmux.py, it must honor PS1 (default: /bin/sh)',
+                        default='/bin/sh')
+    parser.add_argument('--load-command',
+                        help='Command run in the background of the shell for the second phase '
+                             '(default: yes background-output)',
+                        default='yes background-output')
+    parser.add_argument('--no-load',
+                        help='Only measure the latency when idle',
+                        action='store_true')
+    parser.add_argument('--timeout',
+                        help='Time after which a key is considered lost, in seconds (default: 2)',
+                        type=float, default=2)
+    parser.add_argument('--size',
+                        help='Size of the terminal (default: 24x80)',
+                        default='24x80')
+    parser.add_argument('tmux_args',
+                        help='Arguments of tmux.py',
+                        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    height, width = map(int, args.size.split('x'))
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmux.py')
+    tmux_args = args.tmux_args[1:] if args.tmux_args[:1] == ['--'] else args.tmux_args
+    harness = Harness([sys.executable, script] + tmux_args, args.shell, height, width)
+
+    try:
+        harness.wait_for(PROMPT.encode(), 10)
+        report('idle', *harness.measure(args.keys, args.rate, args.timeout))
+
+        if not args.no_load:
+            harness.type(args.load_command.encode() + b' &\r')
+            time.sleep(0.5)
+            report('load', *harness.measure(args.keys, args.rate, args.timeout))
+    except RuntimeError as e:
+        print('error: %s' % e, file=sys.stderr)
+        exit(1)
+    finally:
+        harness.close()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+'''
+Report the response latency of the commands of a session recorded with
+`tmux.py --record FILE`
+'''
+
+import argparse
+import json
+import sys
+
+PREFIX = '\x02'
+
+
+def read_recording(f):
+    '''Iterate over the (time, event, arguments) of a recording'''
+    for line in f:
+        if line.startswith('#'):
+            continue
+
+        timestamp, event, args = line.rstrip('\n').split(' ', 2)
+        yield float(timestamp), event, args
+
+
+class Command:
+    def __init__(self, time, window, text):
+        self.time = time
+        self.window = window
+        self.text = text
+        self.first_output = None # time of the first output
+        self.last_output = None # time of the last output before the session is quiet
+        self.size = 0 # number of characters of output
+
+
+def analyze(events, quiet):
+    '''Return the commands and the latencies of the keystrokes (in seconds)'''
+    window = 0
+    line = {} # window -> text typed since the last Enter
+    commands = []
+    keystrokes = []
+    pending_key = None # (time, window) of the last key without output yet
+    command = None # command waiting for the end of its output
+
+    for timestamp, event, args in events:
+        if event == 'WINDOW':
+            window = int(args)
+        elif event == 'IN':
+            data = json.loads(args)
+
+            if data.startswith(PREFIX):
+                continue
+
+            if command and command.first_output is None:
+                command = None # a new input before any output
+
+            if '\r' in data:
+                text = line.pop(window, '') + data.split('\r')[0]
+                command = Command(timestamp, window, text)
+                commands.append(command)
+                pending_key = None
+            else:
+                typed = line.get(window, '')
+                for c in data:
+                    if c == '\x7f':
+                        typed = typed[:-1]
+                    elif c.isprintable():
+                        typed += c
+                line[window] = typed
+                pending_key = timestamp, window
+        elif event == 'OUT':
+            out_window, data = args.split(' ', 1)
+            out_window, data = int(out_window), json.loads(data)
+
+            if pending_key and pending_key[1] == out_window:
+                keystrokes.append(timestamp - pending_key[0])
+                pending_key = None
+
+            if command and command.window == out_window:
+                if command.first_output is None:
+                    command.first_output = timestamp
+                elif timestamp - command.last_output > quiet:
+                    command = None
+                    continue
+
+                command.last_output = timestamp
+                command.size += len(data)
+
+    return commands, keystrokes
+
+
+def percentiles(values):
+    values = sorted(values)
+    return ', '.join('p%d %.1fms' % (p, values[min(len(values) - 1, len(values) * p // 100)] * 1000)
+                     for p in (50, 90, 99))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the latency of the commands of a recording')
+    parser.add_argument('file',
+                        help='The recording (tmux.py --record FILE)')
+    parser.add_argument('--quiet',
+                        help='Time without output after which a command is finished, '
+                             'in seconds (default: 0.5)',
+                        type=float, default=0.5)
+
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        commands, keystrokes = analyze(read_recording(f), args.quiet)
+
+    print('%10s %6s %12s %12s %8s  %s' % ('time', 'window', 'first output', 'duration',
+                                          'output', 'command'))
+
+    for command in commands:
+        if command.first_output is None:
+            print('%10.3f %6d %12s %12s %8d  %s' % (command.time, command.window, '-', '-', 0,
+                                                    command.text))
+        else:
+            print('%10.3f %6d %10.1fms %10.1fms %8d  %s' % (
+                command.time, command.window, (command.first_output - command.time) * 1000,
+                (command.last_output - command.time) * 1000, command.size, command.text))
+
+    answered = [c for c in commands if c.first_output is not None]
+    if answered:
+        print('commands (%d): first output %s' % (
+            len(answered), percentiles([c.first_output - c.time for c in answered])))
+        print('commands (%d): duration %s' % (
+            len(answered), percentiles([c.last_output - c.time for c in answered])))
+
+    if keystrokes:
+        print('keystrokes (%d): echo %s' % (len(keystrokes), percentiles(keystrokes)))
+
+    if not commands and not keystrokes:
+        print('error: no input in the recording', file=sys.stderr)
+        exit(1)
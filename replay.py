@@ -3,7 +3,7 @@
 import argparse
 import fcntl
 import json
-import platform
+import os
 import re
 import struct
 import sys
@@ -13,28 +13,84 @@ import time
 
 def get_hw(fd):
     '''Return the size of the tty asociated to the given file descriptor'''
-    assert platform.system() != 'Windows'
+    assert sys.platform != 'win32'
 
     buf = fcntl.ioctl(fd, termios.TIOCGWINSZ, b'\x00' * 8)
     return struct.unpack('hhhh', buf)[0:2]
 
 
-def replay(f, check_height=True, check_width=True):
-    # find the size of the screen
+def read_size(f):
+    '''Return the timestamp and the terminal size at the beginning of the log file'''
     while True:
         line = f.readline()
 
         if not line:
-            print('error: could not find the terminal size in the log file', file=sys.stderr)
-            exit(1)
+            return None
 
         match = re.match(r'INFO:replay:(\d+):SIZE (\d+) (\d+)\n', line)
 
         if match:
-            last_timestamp = int(match.group(1))
-            height = int(match.group(2))
-            width = int(match.group(3))
-            break
+            return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+def read_writes(f):
+    '''Iterate over the (timestamp, data) written in the log file'''
+    for line in f:
+        match = re.match(r'INFO:replay:(\d+):WRITE (.*)\n', line)
+
+        if match:
+            yield int(match.group(1)), json.loads(match.group(2))
+
+
+def read_recording(f, window):
+    '''Iterate over the (timestamp, data) of a recording of tmux.py --record
+
+    The data is the output of the given window, as bytes, or the new size
+    (height, width) of the window when the terminal is resized.
+    '''
+    for line in f:
+        if line.startswith('#'):
+            continue
+
+        timestamp, event, args = line.rstrip('\n').split(' ', 2)
+
+        if event == 'SIZE':
+            height, width = map(int, args.split())
+            yield float(timestamp), (height - 1, width) # the last line is the banner
+        elif event == 'OUT':
+            out_window, data = args.split(' ', 1)
+
+            if int(out_window) == window:
+                yield float(timestamp), json.loads(data).encode('utf8', 'surrogateescape')
+
+
+def read_session(f, window=0):
+    '''Return the initial (timestamp, height, width) and an iterator over the (timestamp, data)
+
+    The file is either a recording of tmux.py --record, or a log file.
+    '''
+    if f.readline().startswith('# pytmux recording'):
+        events = read_recording(f, window)
+
+        for timestamp, data in events:
+            if isinstance(data, tuple):
+                return (timestamp,) + data, events
+
+        return None, events
+    else:
+        f.seek(0)
+        return read_size(f), read_writes(f)
+
+
+def replay(f, window=0, check_height=True, check_width=True):
+    # find the size of the screen
+    size, events = read_session(f, window)
+
+    if not size:
+        print('error: could not find the terminal size in the log file', file=sys.stderr)
+        exit(1)
+
+    last_timestamp, height, width = size
 
     # check the terminal size
     real_height, real_width = get_hw(sys.stdout)
@@ -51,37 +107,169 @@ def replay(f, check_height=True, check_width=True):
     sys.stdout.flush()
 
     # play
-    while True:
-        line = f.readline()
+    for timestamp, data in events:
+        diff = timestamp - last_timestamp
+        if diff > 0.005:
+            time.sleep(diff)
 
-        if not line:
-            break
+        if isinstance(data, tuple):
+            continue # the terminal cannot be resized
+
+        sys.stdout.buffer.write(data.encode() if isinstance(data, str) else data)
+        sys.stdout.flush()
+        last_timestamp = timestamp
 
-        match = re.match(r'INFO:replay:(\d+):WRITE (.*)\n', line)
-        if match:
-            timestamp = int(match.group(1))
-            data = json.loads(match.group(2))
 
-            diff = timestamp - last_timestamp
-            if diff > 0.005:
-                time.sleep(diff)
+def render(path, output_format='screen', timestamps=(), history_size=100000, window=0):
+    '''Run a log file through the console emulation, as fast as possible
 
-            sys.stdout.write(data)
-            sys.stdout.flush()
-            last_timestamp = timestamp
+    Returns a list of (timestamp, frame) with a frame for each given
+    timestamp (in seconds since the beginning), and one for the end.
+    '''
+    import tmux
+
+    with open(path) as f:
+        size, events = read_session(f, window)
+
+        if not size:
+            raise ValueError('could not find the terminal size in %s' % path)
+
+        start, height, width = size
+        console = tmux.ConsoleWindow(height, width, 0, 0, history_size, headless=True)
+        timestamps = sorted(timestamps)
+        frames = []
+
+        for timestamp, data in events:
+            while timestamps and timestamp - start > timestamps[0]:
+                frames.append((timestamps.pop(0), render_frame(console, output_format)))
+
+            if isinstance(data, tuple):
+                console.resize(*data, 0, 0)
+            else:
+                console.write(data)
+
+    frames.append((None, render_frame(console, output_format)))
+    return frames
+
+
+def render_frame(console, output_format):
+    import tmux
+
+    if output_format == 'screen':
+        return ''.join(tmux.format_text(line).rstrip() + '\n' for line in console.display_lines())
+    else:
+        return ''.join(tmux.export(console.lines, console.width, output_format))
+
+
+def render_to_files(path, output_dir, output_format, timestamps, history_size, window):
+    '''Render a log file into files in output_dir, return their paths'''
+    frames = render(path, output_format, timestamps, history_size, window)
+    name = os.path.splitext(os.path.basename(path))[0]
+    extension = {'html': 'html', 'ansi': 'ans'}.get(output_format, 'txt')
+    paths = []
+
+    for timestamp, frame in frames:
+        suffix = '' if timestamp is None else '.%gs' % timestamp
+        output = os.path.join(output_dir, '%s%s.%s' % (name, suffix, extension))
+
+        with open(output, 'w') as f:
+            f.write(frame)
+
+        paths.append(output)
+
+    return paths
+
+
+def render_headless(args):
+    if os.path.isdir(args.file):
+        paths = sorted(os.path.join(args.file, name) for name in os.listdir(args.file)
+                       if name.endswith(('.log', '.rec')))
+    else:
+        paths = [args.file]
+
+    if not args.output_dir:
+        if len(paths) > 1:
+            print('error: --output-dir is required to render a directory', file=sys.stderr)
+            exit(1)
+
+        for timestamp, frame in render(paths[0], args.format, args.at, args.history, args.window):
+            if args.at:
+                print('--- %s ---' % ('end' if timestamp is None else '%gs' % timestamp))
+
+            sys.stdout.write(frame)
+
+        return
+
+    import concurrent.futures
+    os.makedirs(args.output_dir, exist_ok=True)
+    errors = 0
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(render_to_files, path, args.output_dir, args.format,
+                                   args.at, args.history, args.window): path
+                   for path in paths}
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                for output in future.result():
+                    print(output)
+            except Exception as e:
+                print('error: %s: %s' % (futures[future], e), file=sys.stderr)
+                errors += 1
+
+    if errors:
+        exit(1)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Replay a tmux session')
     parser.add_argument('file',
-                        help='The log file (example: tmux.log)',
-                        type=argparse.FileType())
+                        help='The log file (example: tmux.log) or a recording of '
+                             'tmux.py --record, or a directory of them (.log or .rec) '
+                             'with --headless')
+    parser.add_argument('--window',
+                        help='Window replayed from a recording, by its number in the order '
+                             'of creation (default: 0)',
+                        type=int,
+                        default=0)
     parser.add_argument('--no-check-height',
                         help='Do not Check the height of the current window',
                         action='store_true')
     parser.add_argument('--no-check-width',
                         help='Do not check the width of the current window',
                         action='store_true')
+    parser.add_argument('--headless',
+                        help='Render the session without a terminal, as fast as possible',
+                        action='store_true')
+    parser.add_argument('--format',
+                        help='With --headless: the last screen, or the whole history '
+                             'as text, ansi or html (default: screen)',
+                        choices=('screen', 'text', 'ansi', 'html'),
+                        default='screen')
+    parser.add_argument('--at',
+                        help='With --headless: also render the session at that time, '
+                             'in seconds since the beginning (can be repeated)',
+                        type=float,
+                        action='append',
+                        default=[])
+    parser.add_argument('--output-dir',
+                        help='With --headless: write the renderings in that directory',
+                        default=None)
+    parser.add_argument('--jobs',
+                        help='With --headless: number of log files rendered in parallel '
+                             '(default: number of cpus)',
+                        type=int,
+                        default=None)
+    parser.add_argument('--history',
+                        help='With --headless: size of the history (default: 100000)',
+                        type=int,
+                        default=100000)
 
     args = parser.parse_args()
-    replay(args.file, not args.no_check_height, not args.no_check_width)
+
+    if args.headless:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        render_headless(args)
+    else:
+        with open(args.file) as f:
+            replay(f, args.window, not args.no_check_height, not args.no_check_width)
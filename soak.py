@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+'''
+Soak test of the emulation of tmux.py: find the memory which grows without bound
+
+A process writes hours' worth of synthetic output (logs in colors, progress
+bars, full-screen applications, titles, wide characters...) as fast as a
+headless ConsoleWindow can read it. Snapshots of tracemalloc are taken
+periodically, the test fails if the memory keeps growing once the history is
+full, and reports the allocation sites which grew the most.
+'''
+
+import argparse
+import gc
+import select
+import sys
+import time
+import tracemalloc
+
+import tmux
+
+# the output of the process, scenes of a long session chosen at random
+GENERATOR = r'''
+import random, sys, time
+
+rng = random.Random(int(sys.argv[1]))
+height, width = int(sys.argv[2]), int(sys.argv[3])
+out = sys.stdout
+
+def color():
+    kind = rng.random()
+    if kind < 0.4:
+        return '\x1b[%dm' % rng.choice((31, 32, 33, 34, 35, 36, 91, 92))
+    elif kind < 0.7:
+        return '\x1b[38;5;%dm' % rng.randrange(256)
+    else:
+        return '\x1b[38;2;%d;%d;%dm' % (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+
+def logs():
+    for _ in range(rng.randint(10, 200)):
+        out.write('%s %s%-5s\x1b[0m %s\r\n' % (
+            time.strftime('%H:%M:%S'), color(),
+            rng.choice(('INFO', 'DEBUG', 'WARN', 'ERROR')),
+            ' '.join('word%d' % rng.randrange(10000) for _ in range(rng.randint(1, 30)))))
+
+def progress():
+    for i in range(101):
+        bar = '#' * (i * (width - 20) // 100)
+        out.write('\r%s%3d%%\x1b[0m [%-*s]' % (color(), i, width - 20, bar))
+    out.write('\r\n')
+
+def full_screen():
+    out.write('\x1b[?1049h\x1b[H\x1b[2J\x1b[2;%dr' % (height - 1))
+    for _ in range(rng.randint(10, 100)):
+        out.write('\x1b[?2026h')
+        for y in range(1, height + 1, rng.randint(1, 4)):
+            out.write('\x1b[%d;1H\x1b[48;5;%dm%s\x1b[0m\x1b[K' % (
+                y, rng.randrange(256), ' %d ' % rng.randrange(10 ** 6)))
+        out.write('\x1b[%dH\n\n\x1b[3L\x1b[2M\x1b[?2026l' % (height - 1))
+    out.write('\x1b[r\x1b[?1049l')
+
+def clear():
+    out.write('\x1b[H\x1b[2J')
+
+def titles():
+    for _ in range(rng.randint(1, 20)):
+        out.write('\x1b]0;job %d\x07\x1b]8;;https://example.com/%d\x1b\\link\x1b]8;;\x1b\\\r\n' % (
+            rng.randrange(10 ** 6), rng.randrange(10 ** 6)))
+
+def long_lines():
+    for _ in range(rng.randint(1, 20)):
+        out.write('\t'.join(rng.choice(('x' * rng.randint(1, 50), '中文', '\U0001f600', 'é'))
+                            for _ in range(rng.randint(1, 100))) + '\r\n')
+
+scenes = [logs] * 6 + [progress, full_screen, clear, titles, long_lines]
+
+while True:
+    rng.choice(scenes)()
+    out.flush()
+'''
+
+
+def run(args, height, width):
+    '''Feed the output of the generator to a console, return the samples
+
+    Each sample is (time, bytes written, traced memory, snapshot).
+    '''
+    console = tmux.ConsoleWindow(height, width, 0, 0, args.history, headless=True)
+    console.reply_query = lambda s: None # the generator does not read its input
+    proc = tmux.Process([sys.executable, '-c', GENERATOR, str(args.seed), str(height), str(width)])
+    tmux.set_hw(proc.fd, height, width)
+
+    samples = []
+    written = 0
+    start = time.monotonic()
+    next_sample = start + args.warmup
+    next_render = start
+
+    try:
+        while time.monotonic() - start < args.duration:
+            select.select([proc.fd], [], [], 1)
+
+            data = proc.read()
+            if data:
+                console.write(data)
+                written += len(data)
+
+            now = time.monotonic()
+
+            if now >= next_render:
+                console.display_lines() # what a renderer would do
+                next_render = now + 1 / 60
+
+            if now >= next_sample:
+                gc.collect()
+                current, _ = tracemalloc.get_traced_memory()
+                samples.append((now - start, written, current, tracemalloc.take_snapshot()))
+                print('%6.0fs %10.1fMB written %8.2fMB traced %6d lines' % (
+                    now - start, written / 1e6, current / 1e6, len(console.lines)))
+                next_sample = now + args.interval
+
+            if proc.poll() is not None:
+                raise RuntimeError('the generator exited')
+    finally:
+        proc.kill()
+        proc.close()
+
+    return samples, console
+
+
+def report_top(first, last, count):
+    '''Print the allocation sites which grew the most between two snapshots'''
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    stats = last.filter_traces(filters).compare_to(first.filter_traces(filters), 'lineno')
+
+    print('top allocation sites:')
+    for stat in stats[:count]:
+        print('  %+10.1fkB %8d blocks  %s' % (stat.size_diff / 1e3, stat.count, stat.traceback))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Soak test of the emulation of tmux.py')
+    parser.add_argument('--duration',
+                        help='Duration of the test, in seconds (default: 300)',
+                        type=float, default=300)
+    parser.add_argument('--warmup',
+                        help='Time to fill the history before the first snapshot, in seconds '
+                             '(default: 20)',
+                        type=float, default=20)
+    parser.add_argument('--interval',
+                        help='Time between two snapshots, in seconds (default: 20)',
+                        type=float, default=20)
+    parser.add_argument('--max-growth',
+                        help='Maximum growth of the memory after the first snapshot, in MB '
+                             '(default: 1)',
+                        type=float, default=1)
+    parser.add_argument('--top',
+                        help='Number of allocation sites reported (default: 10)',
+                        type=int, default=10)
+    parser.add_argument('--seed',
+                        help='Seed of the output (default: 0)',
+                        type=int, default=0)
+    parser.add_argument('--size',
+                        help='Size of the window (default: 24x80)',
+                        default='24x80')
+    parser.add_argument('--history',
+                        help='Size of the history (default: 200)',
+                        type=int, default=200)
+
+    args = parser.parse_args()
+    height, width = map(int, args.size.split('x'))
+    tracemalloc.start()
+
+    try:
+        samples, console = run(args, height, width)
+    except RuntimeError as e:
+        print('error: %s' % e, file=sys.stderr)
+        exit(1)
+
+    if len(samples) < 2:
+        print('error: not enough snapshots, increase --duration', file=sys.stderr)
+        exit(1)
+
+    first, last = samples[0], samples[-1]
+    growth = last[2] - first[2]
+    elapsed = last[0] - first[0]
+    print('%.1fMB written in %.0fs, memory growth %+.2fMB (%+.1fkB/min)' % (
+        last[1] / 1e6, last[0], growth / 1e6, growth / 1e3 / elapsed * 60))
+    report_top(first[3], last[3], args.top)
+
+    if len(console.lines) > args.history:
+        print('error: %d lines in the buffer, more than the history' % len(console.lines),
+              file=sys.stderr)
+        exit(1)
+
+    if growth > args.max_growth * 1e6:
+        print('error: the memory grew by %.2fMB' % (growth / 1e6), file=sys.stderr)
+        exit(1)
@@ -0,0 +1,117 @@
+'''
+Tests of the emulation of tmux.py, run with pytest
+'''
+
+import tmux
+
+
+def make_console(height=8, width=20, history_size=100):
+    console = tmux.ConsoleWindow(height, width, 0, 0, history_size, headless=True)
+    console.reply_query = lambda s: None
+    return console
+
+
+def screen_text(console):
+    return [tmux.format_text(line.rstrip()) for line in console.capture()]
+
+
+def test_delete_lines_in_scroll_area():
+    console = make_console()
+    console.write('\r\n'.join('line%d' % i for i in range(8)))
+    console.write('\x1b[2;6r\x1b[3;1H\x1b[2M')
+
+    assert screen_text(console) == ['line0', 'line1', 'line4', 'line5', '', '',
+                                    'line6', 'line7']
+    assert len(console.lines) == 8
+
+
+def test_insert_lines_in_scroll_area():
+    console = make_console()
+    console.write('\r\n'.join('line%d' % i for i in range(8)))
+    console.write('\x1b[2;6r\x1b[3;1H\x1b[2L')
+
+    assert screen_text(console) == ['line0', 'line1', '', '', 'line2', 'line3',
+                                    'line6', 'line7']
+    assert len(console.lines) == 8
+
+
+def test_scroll_wrapped_lines_in_scroll_area():
+    console = make_console()
+    console.write('\r\n'.join('line%d' % i for i in range(8)))
+    console.scroll_area = 2, 5
+    console._scroll_down(real=False, num=3)
+
+    assert screen_text(console) == ['line0', 'line1', 'line5', '', '', '',
+                                    'line6', 'line7']
+    assert len(console.lines) == 8
+    # the new rows continue the last line of the area
+    assert len({num for _, num in console.lines[2:6]}) == 1
+
+
+def test_export_wrapped_line():
+    console = make_console(width=10)
+    console.write('hello     world\r\nnext')
+
+    assert ''.join(tmux.export(console.lines, console.width)) == 'hello     world\nnext\n'
+
+
+def test_export_snapshot_lines():
+    console = make_console(width=10)
+    console.write('a' * 12 + ' b')
+
+    lines, width = console.snapshot_lines()()
+    assert ''.join(tmux.export(lines, width)) == 'a' * 12 + ' b\n'
+
+
+def test_export_last_output():
+    console = make_console(width=10)
+    console.write('\x1b]133;A\x07$ ls\r\n\x1b]133;C\x07hello     world\r\n\x1b]133;A\x07$ ')
+
+    assert ''.join(tmux.export(console.last_output(), console.width)) == 'hello     world\n'
+
+
+def test_write_budget():
+    data = ''.join('\x1b[3%dmline %d\r\n' % (i % 8, i) for i in range(2000))
+    expected = make_console()
+    expected.write(data)
+
+    console = make_console()
+    console.write(data, budget=0)
+    assert console.backlog and not console.can_write()
+
+    writes = 1
+    while not console.can_write():
+        console.write('', budget=0)
+        writes += 1
+
+    assert writes > 1
+    assert ([line._elements for line in console.display_lines()] ==
+            [line._elements for line in expected.display_lines()])
+    assert console.offset == expected.offset
+
+
+def test_monitor_pattern_flags():
+    monitor = tmux.OutputMonitor(['(?i)failed', 'error'])
+
+    assert monitor.feed(b'build FAILED\r\n') == ['(?i)failed']
+    assert monitor.feed(b'Error\r\nerror\r\n') == ['error']
+
+
+def test_monitor_pattern_split_output():
+    monitor = tmux.OutputMonitor([r'FAIL\w*'])
+
+    assert monitor.feed(b'build FAIL') == [r'FAIL\w*']
+    assert monitor.feed(b'ED now\r\n') == []
+    assert monitor.feed(b'FAI') == []
+    assert monitor.feed(b'L again\r\n') == [r'FAIL\w*']
+
+
+def test_shell_marks_after_clear():
+    console = make_console()
+    console.write('\x1b]133;A\x07$ ls\r\n\x1b]133;C\x07out\r\n\x1b]133;A\x07$ clear\r\n')
+    console.write('\x1b[H\x1b[2J') # the numbers of the lines erased are used again
+    console.write('x\r\ny\r\n\x1b]133;A\x07$ ')
+
+    assert console.prompt_marks == [2]
+    assert console.output_marks == []
+    assert console.last_output() == []
@@ -3,37 +3,49 @@
 A simple tmux clone in python using curses
 '''
 
-from datetime import datetime
-import copy
+import base64
+import bisect
+import codecs
+import collections
 import curses
+import datetime
 import fcntl
+import functools
+import html
 import json
 import locale
 import logging
 import math
 import os
-import platform
 import pty
 import re
 import select
 import signal
 import struct
-import subprocess
 import sys
 import termios
+import threading
 import time
 import unicodedata
+import zlib
 
-logging.basicConfig(filename='tmux.log',
-                    filemode='w',
-                    level=logging.DEBUG)
 log = logging.getLogger('tmux')
+log.addHandler(logging.NullHandler())
 replay = logging.getLogger('replay')
+replay.addHandler(logging.NullHandler())
+
+
+def setup_logging(filename='tmux.log', level=logging.DEBUG, append=False):
+    '''Log into the given file, which is only created on the first message'''
+    handler = logging.FileHandler(filename, mode='a' if append else 'w', delay=True)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.root.addHandler(handler)
+    logging.root.setLevel(level)
 
 
 def get_hw(fd):
     '''Return the size of the tty asociated to the given file descriptor'''
-    assert platform.system() != 'Windows'
+    assert sys.platform != 'win32'
 
     buf = fcntl.ioctl(fd, termios.TIOCGWINSZ, b'\x00' * 8)
     return struct.unpack('hhhh', buf)[0:2]
@@ -41,7 +53,7 @@ def get_hw(fd):
 
 def set_hw(fd, height, width):
     '''Set the size of the tty asociated to the given file descriptor'''
-    assert platform.system() != 'Windows'
+    assert sys.platform != 'win32'
 
     buf = struct.pack('hhhh', height, width, 0, 0)
     fcntl.ioctl(fd, termios.TIOCSWINSZ, buf)
@@ -59,6 +71,11 @@ def can_read(fd):
     return select.select([fd], [], [], 0) == ([fd], [], [])
 
 
+PASTE_START = b'\x1b[200~'
+PASTE_END = b'\x1b[201~'
+PASTE_MIN_SIZE = 256 # reads of that size are pastes, for terminals without bracketed paste
+
+
 class Cursor:
     def __init__(self, y, x, visibility):
         self.y = y
@@ -69,10 +86,19 @@ class Cursor:
         return 'Cursor(y=%d, x=%d, visibility=%d)' % (self.y, self.x, self.visibility)
 
 
+def set_cursor_visibility(cursor, visibility):
+    if cursor.visibility != visibility:
+        curses.curs_set(visibility)
+        cursor.visibility = visibility
+
+
 class Window:
-    def __init__(self, height, width, begin_y, begin_x):
-        self.win = curses.newwin(height, width, begin_y, begin_x)
+    def __init__(self, height, width, begin_y, begin_x, headless=False):
+        # a headless window has no curses window and is never drawn
+        self.win = None if headless else curses.newwin(height, width, begin_y, begin_x)
+        self.audible_bell = not headless # rings the bell of the terminal
         self.size = height, width
+        self.begin = begin_y, begin_x
 
     @property
     def width(self):
@@ -83,13 +109,20 @@ class Window:
         return self.size[0]
 
     def resize(self, height, width, begin_y, begin_x):
-        self.win.mvwin(begin_y, begin_x)
-        self.win.resize(height, width)
+        if self.win is not None:
+            self.win.mvwin(begin_y, begin_x)
+            self.win.resize(height, width)
+
         self.size = height, width
+        self.begin = begin_y, begin_x
 
     def refresh(self):
         raise NotImplementedError
 
+    def close(self):
+        '''Release the resources of the window'''
+        pass
+
 
 class Colors:
     def __init__(self):
@@ -110,19 +143,180 @@ class Colors:
 colors = Colors()
 
 
+def status_clock():
+    return datetime.datetime.now().strftime('%H:%M %d-%m-%Y')
+
+
+def status_load():
+    return '%.2f %.2f %.2f' % os.getloadavg()
+
+
+def status_command(command):
+    '''Return the first line of the output of a shell command'''
+    import subprocess
+    proc = subprocess.run(command, shell=True, timeout=10,
+                          stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL)
+    output = proc.stdout.decode('utf8', 'replace').strip()
+    return output.split('\n')[0]
+
+
+class StatusSegment:
+    '''A value of the status line, cached for `interval` seconds
+
+    Arguments:
+        provider(callable): Returns the value of the segment
+        interval(float): Number of seconds between two updates, or None to
+            compute the value only once
+        background(bool): Run the provider in a thread pool
+    '''
+    def __init__(self, provider, interval=None, background=False):
+        self.provider = provider
+        self.interval = interval
+        self.background = background
+        self.value = ''
+        self.expire = 0
+        self.future = None
+
+    def update(self, now, submit):
+        '''Update the value if needed, return True if it changed
+
+        Arguments:
+            now(float): The current monotonic time
+            submit(callable): Runs the provider in the background, returns a future
+        '''
+        if self.future is not None:
+            if not self.future.done():
+                return False
+
+            future, self.future = self.future, None
+            try:
+                return self._set(future.result())
+            except Exception as e:
+                log.error('status segment %r failed: %s', self.provider, e)
+                return False
+
+        if now < self.expire:
+            return False
+
+        self.expire = now + self.interval if self.interval is not None else math.inf
+
+        if self.background:
+            self.future = submit(self.provider)
+            return False
+
+        return self._set(self.provider())
+
+    def _set(self, value):
+        value = str(value)
+        changed = value != self.value
+        self.value = value
+        return changed
+
+
+class StatusLine:
+    '''A line made of text and segments
+
+    In the format string, `#{name}` is replaced by the segment `name` and
+    `#(command)` by the output of the shell command.
+    '''
+    command_interval = 15
+
+    def __init__(self, fmt, segments):
+        self.parts = []
+        self.segments = []
+
+        pos = 0
+        for match in re.finditer(r'#\{(\w+)\}|#\((.*?)\)', fmt):
+            self.parts.append(fmt[pos:match.start()])
+            pos = match.end()
+
+            if match.group(1):
+                segment = segments[match.group(1)]
+            else:
+                segment = StatusSegment(functools.partial(status_command, match.group(2)),
+                                        interval=self.command_interval,
+                                        background=True)
+
+            self.parts.append(segment)
+            self.segments.append(segment)
+
+        self.parts.append(fmt[pos:])
+
+    def update(self, now, submit):
+        '''Update the segments, return True if one of them changed'''
+        changed = False
+        for segment in self.segments:
+            changed |= segment.update(now, submit)
+        return changed
+
+    def __str__(self):
+        return ''.join(part if isinstance(part, str) else part.value
+                       for part in self.parts)
+
+
+STATUS_LEFT = '#{windows} #{alert}'
+STATUS_RIGHT = '#{memory} "#{host}" #{clock}'
+
+
 class BannerWindow(Window):
-    def refresh(self):
-        self.win.leaveok(1) # avoid cursor blinking
-        left = '[0] tmux.py'
-        right = '"%s" %s' % (platform.node(),
-                             datetime.now().strftime('%H:%M %d-%m-%Y'))
+    def __init__(self, height, width, begin_y, begin_x,
+                 segments=None, left=STATUS_LEFT, right=STATUS_RIGHT, headless=False):
+        super(BannerWindow, self).__init__(height, width, begin_y, begin_x, headless)
+
+        all_segments = {
+            'host': StatusSegment(lambda: os.uname().nodename),
+            'clock': StatusSegment(status_clock, interval=1),
+            'load': StatusSegment(status_load, interval=5),
+        }
+        all_segments.update(segments or {})
+
+        self.left = StatusLine(left, all_segments)
+        self.right = StatusLine(right, all_segments)
+        self.executor = None # thread pool of the background segments, created on demand
+        self.redraw = True
+
+    def submit(self, fn):
+        if self.executor is None:
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+        return self.executor.submit(fn)
+
+    def update(self):
+        '''Update the segments, return True if the banner needs to be redrawn'''
+        now = time.monotonic()
+        self.redraw |= self.left.update(now, self.submit)
+        self.redraw |= self.right.update(now, self.submit)
+        return self.redraw
+
+    def resize(self, height, width, begin_y, begin_x):
+        super(BannerWindow, self).resize(height, width, begin_y, begin_x)
+        self.redraw = True
+
+    def display_line(self):
+        '''Return the banner, as it is drawn'''
+        left = str(self.left)
+        right = str(self.right)
         banner = left + ' ' * (self.width - len(left) - len(right)) + right
+        return FormattedString(banner[:self.width], fg=curses.COLOR_BLACK, bg=curses.COLOR_BLUE)
+
+    def refresh(self):
+        self.update()
 
-        addstr(self.win, 0, 0, banner,
-               colors.attr(curses.COLOR_BLACK, curses.COLOR_BLUE))
+        if not self.redraw:
+            return
 
+        self.win.leaveok(1) # avoid cursor blinking
+        add_formatted_str(self.win, 0, 0, self.display_line())
         self.win.refresh()
         self.win.leaveok(0)
+        self.redraw = False
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
 
 
 class FormattedString:
@@ -132,6 +326,8 @@ class FormattedString:
         else:
             self._elements = []
 
+        self._size = None # see memory_size()
+
     def __len__(self):
         return sum(len(text) for text, _, _, _ in self._elements)
 
@@ -140,11 +336,12 @@ class FormattedString:
 
     def _clone(self):
         o = FormattedString()
-        o._elements = copy.copy(self._elements)
+        o._elements = list(self._elements)
         return o
 
     def _add(self, o):
         assert isinstance(o, FormattedString)
+        self._size = None
 
         for text, attr, fg, bg in o._elements:
             if self._elements and self._elements[-1][1:] == (attr, fg, bg):
@@ -231,21 +428,305 @@ class FormattedString:
 
         return o
 
+    def memory_size(self):
+        '''Return an estimate of the memory used by the string, in bytes
+
+        A string is never modified once built, the size is computed once.
+        '''
+        if self._size is None:
+            self._size = (STRING_SIZE + sys.getsizeof(self._elements) +
+                          sum(ELEMENT_SIZE + sys.getsizeof(text) for text, _, _, _ in self._elements))
+
+        return self._size
+
     def __repr__(self):
         return 'FormattedString(%r)' % self._elements
 
 
+# estimates of the memory used by the parts of a line, see memory_size()
+STRING_SIZE = sys.getsizeof(FormattedString()) + 64 # and the values of its attributes
+ELEMENT_SIZE = sys.getsizeof(('', 0, -1, -1))
+LINE_SIZE = sys.getsizeof([None, 0]) # the list [formatted string, real line number]
+
+
+def unctrl(c):
+    '''Return a printable representation of a control character
+
+    This is similar to curses.unctrl(), which only considers the low byte of
+    the character, but works without initializing curses.
+    '''
+    code = ord(c) & 0xff
+
+    if code < 0x20 or code == 0x7f:
+        return '^' + chr(code ^ 0x40)
+    elif 0x80 <= code < 0xa0 or code == 0xff:
+        return '~' + chr((code - 0x80) ^ 0x40)
+    elif code >= 0xa0:
+        return 'M-' + chr(code - 0x80)
+    else:
+        return chr(code)
+
+
 def add_formatted_str(win, y, x, s):
     for text, attr, fg, bg in s._elements:
         addstr(win, y, x, text, attr | colors.attr(fg, bg))
         x += len(text)
 
 
+class AnsiRenderer:
+    '''Draw the screen with escape sequences, instead of curses windows
+
+    The renderer keeps the last frame it emitted and only emits the
+    differences with the new frame, in a single write. The sequences come
+    from the terminfo database loaded by curses.
+    '''
+    attributes = ((curses.A_BOLD, 'bold'),
+                  (curses.A_DIM, 'dim'),
+                  (curses.A_UNDERLINE, 'smul'),
+                  (curses.A_BLINK, 'blink'),
+                  (curses.A_REVERSE, 'rev'),
+                  (curses.A_INVIS, 'invis'))
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.cap = {name: curses.tigetstr(name) or b''
+                    for name in ('smcup', 'clear', 'cup', 'el', 'sgr0', 'setaf', 'setab',
+                                 'civis', 'cnorm')}
+        self.cap.update((name, curses.tigetstr(name) or b'') for _, name in self.attributes)
+        self.last_column = curses.tigetflag('xenl') > 0 # writing the last cell does not scroll
+        self.styles = {} # (attr, fg, bg) -> sequence
+        self.frame = None # last frame emitted: list of (elements, end of the text)
+        self.cursor = None
+        self.cursor_visibility = None
+
+    def invalidate(self):
+        '''Redraw the whole screen on the next frame'''
+        self.frame = None
+
+    def _style(self, attr, fg, bg):
+        key = attr, fg, bg
+
+        if key not in self.styles:
+            seq = self.cap['sgr0']
+            for flag, name in self.attributes:
+                if attr & flag:
+                    seq += self.cap[name]
+            if fg != -1 and self.cap['setaf']:
+                seq += curses.tparm(self.cap['setaf'], fg)
+            if bg != -1 and self.cap['setab']:
+                seq += curses.tparm(self.cap['setab'], bg)
+
+            self.styles[key] = seq
+
+        return self.styles[key]
+
+    def _move(self, y, x):
+        return curses.tparm(self.cap['cup'], y, x)
+
+    def render(self, lines, cursor):
+        '''Draw the lines (FormattedString) and place the cursor (None to hide it)'''
+        out = []
+
+        if self.frame is None:
+            out.append(self.cap['smcup'] + self.cap['clear'])
+            self.frame = []
+            self.cursor_visibility = None
+
+        self.frame = (self.frame + [((), 0)] * len(lines))[:len(lines)]
+        style = None
+
+        for y, line in enumerate(lines):
+            elements = tuple(line._elements)
+            prev_elements, prev_end = self.frame[y]
+
+            if elements == prev_elements:
+                continue
+
+            # the trailing blanks are erased instead of written
+            end = len(line)
+            for text, attr, fg, bg in reversed(elements):
+                if attr or fg != -1 or bg != -1:
+                    break
+
+                stripped = text.rstrip(' ')
+                end -= len(text) - len(stripped)
+                if stripped:
+                    break
+
+            if y == len(lines) - 1 and not self.last_column:
+                end = min(end, len(line) - 1)
+
+            # skip the beginning of the line that did not change
+            x = 0
+            i = 0
+            while (i < len(elements) and i < len(prev_elements)
+                   and elements[i] == prev_elements[i]):
+                x += len(elements[i][0])
+                i += 1
+
+            if i < len(elements) and i < len(prev_elements) and elements[i][1:] == prev_elements[i][1:]:
+                text, prev_text = elements[i][0], prev_elements[i][0]
+                n = 0
+                while n < len(text) and n < len(prev_text) and text[n] == prev_text[n]:
+                    n += 1
+                x += n
+                elements = ((text[n:],) + elements[i][1:],) + elements[i + 1:]
+            else:
+                elements = elements[i:]
+
+            if x < end:
+                out.append(self._move(y, x))
+
+                for text, attr, fg, bg in elements:
+                    text = text[:end - x]
+                    if not text:
+                        break
+
+                    if style != (attr, fg, bg):
+                        style = attr, fg, bg
+                        out.append(self._style(*style))
+
+                    out.append(text.encode('utf8', 'replace'))
+                    x += len(text)
+
+            if end < prev_end:
+                if style != (0, -1, -1):
+                    style = 0, -1, -1
+                    out.append(self._style(*style))
+
+                out.append(self._move(y, end) + self.cap['el'])
+
+            self.frame[y] = tuple(line._elements), end
+
+        visibility = 1 if cursor else 0
+        if visibility != self.cursor_visibility:
+            out.append(self.cap['cnorm'] if visibility else self.cap['civis'])
+            self.cursor_visibility = visibility
+
+        if cursor and (out or cursor != self.cursor):
+            out.append(self._move(*cursor))
+
+        self.cursor = cursor
+        self._write(b''.join(out))
+
+    def close(self):
+        '''Restore the attributes and the cursor of the terminal'''
+        self._write(self.cap['sgr0'] + self.cap['cnorm'])
+
+    def _write(self, data):
+        while data:
+            try:
+                data = data[os.write(self.fd, data):]
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+
+
+PARAM_MAX = 99999
+
+TAB_WIDTH = 8 # default distance between two tab stops
+TABS = re.compile('\t+')
+
+
+def param(s, default=1):
+    '''Parse a numeric parameter of a control sequence, capped to PARAM_MAX'''
+    if not s:
+        return default
+
+    s = s.lstrip('0') or '0'
+    return int(s) if len(s) <= len(str(PARAM_MAX)) else PARAM_MAX
+
+
+def params(s, default=1):
+    '''Parse the parameters of a control sequence, separated by ;'''
+    return [param(p, default) for p in s.split(';')]
+
+
+CONTROL_SEQUENCES = [(r'\x1b\[(\d+;\d+)?H', '_ctl_cursor_home'),
+                     (r'\x1b\[(\d+;\d+)?f', '_ctl_cursor_home'),
+                     (r'\x1b\[(\d+)?A', '_ctl_cursor_up'),
+                     (r'\x1b\[(\d+)?B', '_ctl_cursor_down'),
+                     (r'\x1b\[(\d+)?C', '_ctl_cursor_forward'),
+                     (r'\x1b\[(\d+)?D', '_ctl_cursor_backward'),
+                     (r'\x1b\[(\d+)?d', '_ctl_cursor_vertical_pos'),
+                     (r'\x1b\[(\d+)?G', '_ctl_cursor_horizontal_pos'),
+                     (r'\x1b\[(\d+)?I', '_ctl_tab_forward'),
+                     (r'\x1b\[(\d+)?Z', '_ctl_tab_backward'),
+                     (r'\x1bH', '_ctl_set_tab_stop'),
+                     (r'\x1b\[(\d+)?g', '_ctl_clear_tab_stop'),
+                     (r'\x1b\[0?K', '_ctl_erase_end_line'),
+                     (r'\x1b\[1K', '_ctl_erase_start_line'),
+                     (r'\x1b\[2K', '_ctl_erase_entire_line'),
+                     (r'\x1b\[0?J', '_ctl_erase_down'),
+                     (r'\x1b\[1J', '_ctl_erase_up'),
+                     (r'\x1b\[2J', '_ctl_erase_screen'),
+                     (r'\x1b\[(\d+)?@', '_ctl_erase_char'),
+                     (r'\x1b\[(\d+)?X', '_ctl_erase_char'),
+                     (r'\x1b\[(\d+)?L', '_ctl_insert_line'),
+                     (r'\x1b\[(\d+)?P', '_ctl_delete_char'),
+                     (r'\x1b\[(\d+)?M', '_ctl_delete_line'),
+                     (r'\x1b\[(\d+(;\d+)*)?r', '_ctl_scroll_area'),
+                     (r'\x1bD', '_ctl_scroll_down'),
+                     (r'\x1bM', '_ctl_scroll_up'),
+                     (r'\x1b=', '_ctl_application_keypad'),
+                     (r'\x1b>', '_ctl_normal_keypad'),
+                     (r'\x1b\[(\d+(;\d+)*)?m', '_ctl_attr'),
+                     (r'\x1b(\)|\(|\*|\+)[a-zA-Z]', '_ctl_ignore'),
+                     (r'\x1b\]133;([A-D])[^\x07\x1b]*(\x07|\x1b\\)', '_ctl_shell_mark'),
+                     (r'\x1b\][^\x07\x1b]*(\x07|\x1b\\)', '_ctl_ignore'), # OSC, ended by BEL or ST
+                     (r'\x1b\[(\d+(;\d+)*)(h|l)', '_ctl_set_mode'),
+                     (r'\x1b\[\?(\d+(;\d+)*)(h|l)', '_ctl_private_set_mode'),
+                     (r'\x1b\[\?(\d+)\$p', '_ctl_query_private_mode'),
+                     (r'\x1b\[c', '_ctl_query_code'),
+                     (r'\x1b\[5n', '_ctl_query_status'),
+                     (r'\x1b\[6n', '_ctl_query_cursor_pos'),
+                     (r'\x1b\[>c', '_ctl_query_term_id')]
+
+CONTROL_SEQUENCES = [(re.compile(regex), name) for regex, name in CONTROL_SEQUENCES]
+
+# prefix of a control sequence which is not complete yet
+INCOMPLETE_SEQUENCE = re.compile(r'\x1b(\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[()*+#%])?')
+
+# any control sequence, known or not
+ANY_SEQUENCE = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[()*+#%].|[^\[\]])')
+
+# global inline flags at the start of a regular expression
+GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+
+
+class Histogram:
+    '''Count observed durations in buckets, like a Prometheus histogram
+
+    `counts` has a count per bucket, of the values up to its bound, and a
+    last count for the values over the last bound.
+    '''
+    buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1) # in seconds
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
 class ConsoleWindow(Window):
-    def __init__(self, height, width, begin_y, begin_x, history_size, reply_query=None):
-        super(ConsoleWindow, self).__init__(height, width, begin_y, begin_x)
+    synchronized_timeout = 0.15 # maximum duration of a synchronized update, in seconds
+    max_pending = 4096 # maximum size of an incomplete control sequence
+    budget_check = 1024 # characters written between two checks of the budget, see write()
+    max_errors = 10 # errors logged per second
+
+    def __init__(self, height, width, begin_y, begin_x, history_size, reply_query=None,
+                 headless=False):
+        super(ConsoleWindow, self).__init__(height, width, begin_y, begin_x, headless)
         self.history_size = history_size
         self.reply_query = reply_query
+        self.decoder = codecs.getincrementaldecoder('utf8')('replace')
+        self.pending = '' # control sequence split between two writes
+        self.backlog = '' # data not written yet, when the budget of write() was spent
+        self.errors = 0 # errors in the last second, see _error()
+        self.errors_time = 0
 
         replay.info('%d:SIZE %d %d', time.time(), self.height, self.width)
 
@@ -270,6 +751,34 @@ class ConsoleWindow(Window):
         self.display_offset = 0 # first line of the display window
         self.auto_scroll = True
 
+        # state of the primary screen while the alternate screen is active
+        self.primary_screen = None
+
+        # memory used by the first lines of the history of the primary
+        # screen, which are not modified anymore, see memory_usage()
+        self.history_bytes = 0
+        self.history_counted = 0 # lines
+
+        self.bracketed_paste = False
+        self.bell_count = 0
+
+        # end of the synchronized update (mode 2026) in progress, if any
+        self.synchronized_until = None
+
+        # tab stops: a flag per column, and the next and previous stop of each column
+        self.tab_stops = bytearray(x > 0 and x % TAB_WIDTH == 0 for x in range(width))
+        self._update_tab_stops()
+
+        # marks of the shell integration (OSC 133) in the primary screen: the
+        # sorted real line numbers of the prompts and of the command outputs
+        self.prompt_marks = []
+        self.output_marks = []
+
+        # metrics, see metrics()
+        self.sequences = collections.Counter() # handled control sequences, by handler
+        self.unknown_sequences = 0
+        self.write_time = Histogram()
+
         self.redraw = True
 
     def _log_state(self):
@@ -284,9 +793,20 @@ class ConsoleWindow(Window):
     def resize(self, height, width, begin_y, begin_x):
         prev_height, prev_width = self.size
         real_y, real_x = self._cursor_real_pos()
+        self._count_history() # the lines back in the real window can be modified
         super(ConsoleWindow, self).resize(height, width, begin_y, begin_x)
         self.scroll_area = 0, height - 1
 
+        if self.primary_screen is not None:
+            self.history_size = height # the alternate screen has no history
+
+        if len(self.tab_stops) != width:
+            # the new columns get the default tab stops
+            self.tab_stops = (self.tab_stops[:width] +
+                              bytearray(x % TAB_WIDTH == 0
+                                        for x in range(len(self.tab_stops), width)))
+            self._update_tab_stops()
+
         if prev_height != height:
             diff = prev_height - height
             if prev_height > height and self.cursor.y < height:
@@ -318,8 +838,11 @@ class ConsoleWindow(Window):
         while self.offset + self.cursor.y >= len(self.lines):
             self._insert_newline(real=False)
 
+        self._count_history()
         self.redraw = True
-        self._log_state()
+
+        if log.isEnabledFor(logging.DEBUG):
+            self._log_state()
 
     def _rebuild_lines(self, prev_width, new_width):
         lines = []
@@ -349,64 +872,126 @@ class ConsoleWindow(Window):
 
         self.lines = lines
 
+        if self.primary_screen is None:
+            self.history_bytes = self.history_counted = 0
+
+    def display_lines(self):
+        '''Return the lines of the display window, as they are drawn'''
+        lines = []
+        for i in range(self.display_offset, self.display_offset + self.height):
+            line = self.lines[i][0] if i < len(self.lines) else FormattedString()
+            lines.append(line.ljust(self.width, ' '))
+
+        if not self.auto_scroll:
+            text = FormattedString('[%d/%d]' % (self.offset - self.display_offset, self.offset),
+                                   fg=curses.COLOR_BLACK,
+                                   bg=curses.COLOR_BLUE)
+            lines[0] = (lines[0][:max(0, self.width - len(text))] + text)[:self.width]
+
+        return lines
+
+    def display_cursor(self):
+        '''Return the position of the cursor in the display window, or None'''
+        y = self.offset + self.cursor.y - self.display_offset
+
+        if 0 <= y < self.height:
+            return y, min(self.cursor.x, self.width - 1)
+        else:
+            return None
+
+    def synchronized_update(self):
+        '''Return True while the process is drawing a frame that is not complete'''
+        if self.synchronized_until is not None and time.monotonic() >= self.synchronized_until:
+            self.synchronized_until = None
+
+        return self.synchronized_until is not None
+
     def refresh(self):
+        if self.win is None or self.synchronized_update():
+            return
+
         if self.redraw:
             self.win.leaveok(1) # avoid cursor blinking
 
-            for i in range(self.display_offset, self.display_offset + self.height):
-                line = self.lines[i][0] if i < len(self.lines) else FormattedString()
-                line = line.ljust(self.width, ' ')
-                add_formatted_str(self.win, i - self.display_offset, 0, line)
-
-            if not self.auto_scroll:
-                text = FormattedString('[%d/%d]' % (self.offset - self.display_offset, self.offset),
-                                       fg=curses.COLOR_BLACK,
-                                       bg=curses.COLOR_BLUE)
-                add_formatted_str(self.win, 0, self.width - len(text), text)
+            for y, line in enumerate(self.display_lines()):
+                add_formatted_str(self.win, y, 0, line)
 
             self.redraw = False
             self.win.leaveok(0)
 
-        if 0 <= self.offset + self.cursor.y - self.display_offset < self.height:
-            self.win.move(self.offset + self.cursor.y - self.display_offset,
-                          min(self.cursor.x, self.width - 1))
-            visibility = 1
-        else:
-            visibility = 0
-
-        if self.cursor.visibility != visibility:
-            curses.curs_set(visibility)
-            self.cursor.visibility = visibility
+        cursor = self.display_cursor()
+        if cursor:
+            self.win.move(*cursor)
 
+        set_cursor_visibility(self.cursor, 1 if cursor else 0)
         self.win.refresh()
 
-    def write(self, data):
-        '''Write data at the current cursor position'''
+    def write(self, data, budget=None):
+        '''Write data at the current cursor position
+
+        With a `budget`, the emulation stops after that many seconds: the rest
+        of the data is kept in `backlog` and written first by the next call.
+        The time is checked every `budget_check` characters.
+        '''
         assert self.offset + self.cursor.y < len(self.lines)
+        start = time.perf_counter()
 
-        if isinstance(data, bytes):
-            data = data.decode('utf8', 'replace')
+        if not isinstance(data, str):
+            # multi-bytes characters can be split between two reads
+            data = self.decoder.decode(data)
 
         log.debug('write: %r', data)
-        replay.info('%d:WRITE %s', time.time(), json.dumps(data))
+        if replay.isEnabledFor(logging.INFO):
+            replay.info('%d:WRITE %s', time.time(), json.dumps(data))
+
+        if self.pending or self.backlog:
+            data, self.pending, self.backlog = self.pending + self.backlog + data, '', ''
 
         current = ''
-        while data:
-            c = data[0]
-            remove = 1
+        pos = 0
+        next_check = self.budget_check if budget is not None else len(data)
+        while pos < len(data):
+            if pos >= next_check:
+                if time.perf_counter() - start > budget:
+                    self.backlog = data[pos:]
+                    break
+
+                next_check = pos + self.budget_check
+
+            c = data[pos]
 
             if c == '\x1b':
                 self._write_line(current)
-                remove = self._control_seq(data)
                 current = ''
+                size = self._control_seq(data, pos)
+
+                if size is None: # the end of the sequence is in the next write
+                    if len(data) - pos <= self.max_pending:
+                        self.pending = data[pos:]
+                        break
+
+                    self._error('Control sequence too long %r', data[pos:pos + 16])
+                    size = 1
+
+                pos += size
+                continue
             elif c == '\a':
-                curses.beep()
+                self.bell_count += 1
+                if self.audible_bell:
+                    curses.beep()
             elif c == '\b':
                 self._write_line(current)
                 self.cursor.x = max(0, self.cursor.x - 1)
                 current = ''
             elif c == '\t':
-                current = self._expand_tab(current)
+                self._write_line(current)
+                current = ''
+
+                # a run of tabs moves the cursor at once
+                size = TABS.match(data, pos).end() - pos
+                self._tab_forward(size)
+                pos += size
+                continue
             elif c == '\n':
                 self._write_line(current)
                 self._cursor_newline(real=True)
@@ -417,14 +1002,25 @@ class ConsoleWindow(Window):
                 current = ''
             else:
                 if unicodedata.category(c) in ('Cc', 'Cf', 'Cn', 'Cs'): # control characters
-                    c = curses.unctrl(ord(c)).decode('utf8')
+                    c = unctrl(c)
 
                 current += c
 
-            data = data[remove:]
+            pos += 1
 
         self._write_line(current)
-        self._log_state()
+        self.write_time.observe(time.perf_counter() - start)
+
+        if log.isEnabledFor(logging.DEBUG):
+            self._log_state()
+
+    def can_write(self):
+        '''Return True if the data written are emulated at once, without a backlog'''
+        return not self.backlog
+
+    def write_limit(self):
+        '''Return the number of bytes which can be written, or None without limit'''
+        return None
 
     def _cursor_newline(self, real):
         '''Add a new line at the cursor position (if needed)
@@ -444,18 +1040,20 @@ class ConsoleWindow(Window):
             if self.offset + self.cursor.y > len(self.lines) - 1:
                 self._insert_newline(real)
 
-    def _insert_newline(self, real):
-        '''Insert a new line at the end of the buffer
+    def _insert_newline(self, real, num=1):
+        '''Insert new lines at the end of the buffer
 
         Arguments:
             real(bool): Is it a real line or just a line wrapped?
+            num(int): The number of lines
         '''
-        assert len(self.lines) + 1 <= self.offset + self.height
+        assert len(self.lines) + num <= self.offset + self.height
 
         line_num = self.lines[-1][1]
-        if real:
-            line_num += 1
-        self.lines.append([FormattedString(), line_num])
+        for _ in range(num):
+            if real:
+                line_num += 1
+            self.lines.append([FormattedString(), line_num])
 
         self._check_history_size()
 
@@ -464,6 +1062,7 @@ class ConsoleWindow(Window):
         assert len(self.lines) > 0
 
         self.lines.pop()
+        self._remove_marks_after(self.lines[-1][1] + 1 if self.lines else 0)
 
     def _check_history_size(self):
         '''Shrink the history if needed
@@ -471,10 +1070,23 @@ class ConsoleWindow(Window):
         Note: that method can update self.lines, self.display_offset and self.offset
         '''
         if len(self.lines) > self.history_size:
-            nb = len(self.lines) - self.history_size
-            self.lines = self.lines[nb:]
-            self.display_offset = max(0, self.display_offset - nb)
-            self.offset -= nb
+            self._remove_history(len(self.lines) - self.history_size)
+
+    def _remove_history(self, nb):
+        '''Remove the first `nb` lines of the buffer'''
+        if self.primary_screen is None:
+            self._uncount_history(self.lines, nb)
+
+        del self.lines[:nb]
+
+        if self.primary_screen is None:
+            self._remove_marks(self.lines[0][1])
+
+        if self.display_offset < nb:
+            self.redraw = True # the lines displayed were removed
+
+        self.display_offset = max(0, self.display_offset - nb)
+        self.offset -= nb
 
     def _update_line(self, y, x, data):
         assert isinstance(data, (str, FormattedString))
@@ -491,7 +1103,8 @@ class ConsoleWindow(Window):
                             self.lines[y][0][x + len(data):]).rstrip()
 
         # update screen directly (only if the window won't be redraw completely)
-        if not self.redraw and self.display_offset <= y < self.display_offset + self.height:
+        if (self.win is not None and not self.redraw and
+                self.display_offset <= y < self.display_offset + self.height):
             add_formatted_str(self.win, y - self.display_offset, x, data)
 
     def _write_line(self, data):
@@ -551,78 +1164,209 @@ class ConsoleWindow(Window):
 
         self.cursor.y, self.cursor.x = y, x
 
-    def _expand_tab(self, current):
-        _, x = self._cursor_real_pos() # num of chars before the cursor
-        x += len(current) # num of chars after the cursor
-        return current + ' ' * (8 - x % 8)
-
-    def _control_seq(self, data):
-        for regex, fun in ((r'^\x1b\[(\d+;\d+)?H', self._ctl_cursor_home),
-                           (r'^\x1b\[(\d+;\d+)?f', self._ctl_cursor_home),
-                           (r'^\x1b\[(\d+)?A', self._ctl_cursor_up),
-                           (r'^\x1b\[(\d+)?B', self._ctl_cursor_down),
-                           (r'^\x1b\[(\d+)?C', self._ctl_cursor_forward),
-                           (r'^\x1b\[(\d+)?D', self._ctl_cursor_backward),
-                           (r'^\x1b\[(\d+)?d', self._ctl_cursor_vertical_pos),
-                           (r'^\x1b\[(\d+)?G', self._ctl_cursor_horizontal_pos),
-                           (r'^\x1b\[0?K', self._ctl_erase_end_line),
-                           (r'^\x1b\[1K', self._ctl_erase_start_line),
-                           (r'^\x1b\[2K', self._ctl_erase_entire_line),
-                           (r'^\x1b\[0?J', self._ctl_erase_down),
-                           (r'^\x1b\[1J', self._ctl_erase_up),
-                           (r'^\x1b\[2J', self._ctl_erase_screen),
-                           (r'^\x1b\[(\d+)?@', self._ctl_erase_char),
-                           (r'^\x1b\[(\d+)?X', self._ctl_erase_char),
-                           (r'^\x1b\[(\d+)?L', self._ctl_insert_line),
-                           (r'^\x1b\[(\d+)?P', self._ctl_delete_char),
-                           (r'^\x1b\[(\d+)?M', self._ctl_delete_line),
-                           (r'^\x1b\[(\d+(;\d+)*)?r', self._ctl_scroll_area),
-                           (r'^\x1bD', self._ctl_scroll_down),
-                           (r'^\x1bM', self._ctl_scroll_up),
-                           (r'^\x1b=', self._ctl_application_keypad),
-                           (r'^\x1b>', self._ctl_normal_keypad),
-                           (r'^\x1b\[(\d+(;\d+)*)?m', self._ctl_attr),
-                           (r'^\x1b(\)|\(|\*|\+)[a-zA-Z]', lambda s: None),
-                           (r'^\x1b\]\d+(;[^\a]+)*\a', lambda s: None),
-                           (r'^\x1b\[(\d+(;\d+)*)(h|l)', self._ctl_set_mode),
-                           (r'^\x1b\[\?(\d+(;\d+)*)(h|l)', self._ctl_private_set_mode),
-                           (r'^\x1b\[c', self._ctl_query_code),
-                           (r'^\x1b\[5n', self._ctl_query_status),
-                           (r'^\x1b\[6n', self._ctl_query_cursor_pos),
-                           (r'^\x1b\[>c', self._ctl_query_term_id)):
-            match = re.search(regex, data)
+    def _update_tab_stops(self):
+        '''Compute the next and previous tab stops of each column
+
+        Without a tab stop after a column, the next one is the last column.
+        '''
+        width = len(self.tab_stops)
+        self.next_tab = [0] * width
+        self.prev_tab = [0] * width
+
+        stop = width - 1
+        for x in range(width - 1, -1, -1):
+            self.next_tab[x] = stop
+            if self.tab_stops[x]:
+                stop = x
+
+        stop = 0
+        for x in range(width):
+            self.prev_tab[x] = stop
+            if self.tab_stops[x]:
+                stop = x
+
+    def _tab_forward(self, num=1):
+        '''Move the cursor to the num-th next tab stop'''
+        x = self.cursor.x
+        if x >= self.width - 1:
+            return # the next stop of the last column is itself
+
+        for _ in range(num):
+            x = self.next_tab[x]
+            if x == self.width - 1:
+                break
+
+        self.cursor.x = x
+
+    def _tab_backward(self, num=1):
+        '''Move the cursor to the num-th previous tab stop'''
+        x = min(self.cursor.x, self.width - 1)
+
+        for _ in range(num):
+            x = self.prev_tab[x]
+            if x == 0:
+                break
+
+        self.cursor.x = x
+
+    def _control_seq(self, data, pos=0):
+        '''Handle the control sequence at data[pos]
+
+        Returns its length, or None if the sequence is not complete yet.
+        '''
+        for regex, name in CONTROL_SEQUENCES:
+            match = regex.match(data, pos)
             if match:
-                log.debug('control sequence %r -> %s', match.group(0), fun.__name__)
-                fun(match)
-                return len(match.group(0))
+                log.debug('control sequence %r -> %s', match.group(0), name)
+                self.sequences[name] += 1
+                getattr(self, name)(match)
+                return match.end() - pos
+
+        if INCOMPLETE_SEQUENCE.fullmatch(data, pos):
+            return None
+
+        # skip the whole sequence
+        match = ANY_SEQUENCE.match(data, pos)
+        self.unknown_sequences += 1
+        self._error('Unable to parse control sequence %r', data[pos:pos + 16])
+        return match.end() - pos if match else 1
+
+    def _error(self, msg, *args):
+        '''Log an error, at most `max_errors` per second'''
+        now = time.monotonic()
+
+        if now - self.errors_time >= 1:
+            if self.errors > self.max_errors:
+                log.error('%d errors not logged', self.errors - self.max_errors)
+
+            self.errors_time = now
+            self.errors = 0
+
+        self.errors += 1
+        if self.errors <= self.max_errors:
+            log.error(msg, *args)
+
+    def _ctl_ignore(self, match):
+        pass
+
+    def _ctl_shell_mark(self, match):
+        '''OSC 133: A starts a prompt, B the command, C its output and D ends it
 
-        log.error('Unable to parse control sequence %r', data[:16])
-        return 1
+        The real line numbers of the prompts and the outputs are recorded.
+        '''
+        marks = {'A': self.prompt_marks, 'C': self.output_marks}.get(match.group(1))
+        if marks is None or self.primary_screen is not None:
+            return
+
+        num = self.lines[self.offset + self.cursor.y][1]
+        i = bisect.bisect_left(marks, num)
+        if i == len(marks) or marks[i] != num:
+            marks.insert(i, num)
+
+    def _remove_marks(self, first_num):
+        '''Remove the marks of the lines before the real line `first_num`'''
+        for marks in (self.prompt_marks, self.output_marks):
+            if marks and marks[0] < first_num:
+                del marks[:bisect.bisect_left(marks, first_num)]
+
+    def _remove_marks_after(self, num):
+        '''Remove the marks of the real line `num` and of the following lines'''
+        if self.primary_screen is not None:
+            return # the lines of the alternate screen have no marks
+
+        for marks in (self.prompt_marks, self.output_marks):
+            if marks and marks[-1] >= num:
+                del marks[bisect.bisect_left(marks, num):]
+
+    def _index_mark(self, num):
+        '''Return the index in self.lines of the first line at or after the real line `num`'''
+        return bisect.bisect_left(self.lines, num, key=lambda line: line[1])
 
     def _ctl_set_mode(self, match):
         val = match.groups()[-1] == 'h'
 
-        for num in map(int, match.group(1).split(';')):
-            if num == 4:
-                assert not val, 'insert mode not supported'
+        for num in params(match.group(1)):
+            if num == 4 and not val:
                 continue # ignored
             else:
-                log.error('Unknow control sequence %r', match.group(0))
+                self._error('Unknow control sequence %r', match.group(0))
 
     def _ctl_private_set_mode(self, match):
         val = match.groups()[-1] == 'h'
 
-        for num in map(int, match.group(1).split(';')):
-            if num in (1, 12, 25, 1049, 2004):
+        for num in params(match.group(1)):
+            if num in (47, 1047, 1049):
+                if val:
+                    self._enter_alternate_screen(save_cursor=(num == 1049))
+                else:
+                    self._leave_alternate_screen()
+            elif num == 2004:
+                self.bracketed_paste = val
+            elif num == 2026:
+                self.synchronized_until = time.monotonic() + self.synchronized_timeout if val else None
+            elif num in (1, 12, 25):
                 continue # ignored
             elif num in (1000, 1001, 1002, 1005, 1006):
                 continue # ignore all mouse modes
             else:
-                log.error('Unknow control sequence %r', match.group(0))
+                self._error('Unknow control sequence %r', match.group(0))
+
+    def _enter_alternate_screen(self, save_cursor):
+        '''Switch to a blank screen without history
+
+        The primary screen is kept aside until _leave_alternate_screen()
+        '''
+        if self.primary_screen is not None:
+            return
+
+        saved_cursor = None
+        if save_cursor:
+            saved_cursor = (self.cursor.y, self.cursor.x, self.attr, self.fg, self.bg)
+
+        self.primary_screen = (self.lines, self.offset, self.history_size,
+                               self.size, saved_cursor)
+
+        self.lines = [[FormattedString(), i] for i in range(self.height)]
+        self.offset = 0
+        self.display_offset = 0
+        self.auto_scroll = True
+        self.history_size = self.height
+        self.redraw = True
+
+    def _leave_alternate_screen(self):
+        '''Discard the alternate screen and restore the primary screen'''
+        if self.primary_screen is None:
+            return
+
+        lines, offset, history_size, size, saved_cursor = self.primary_screen
+        self.primary_screen = None
+
+        self.lines = lines
+        self.offset = offset
+        self.display_offset = offset
+        self.auto_scroll = True
+        self.history_size = history_size
+
+        if saved_cursor:
+            self.cursor.y, self.cursor.x, self.attr, self.fg, self.bg = saved_cursor
+
+        if size != self.size:
+            # the window was resized while the alternate screen was active
+            height, width = self.size
+            self.size = size
+            self.cursor.y = min(self.cursor.y, size[0] - 1)
+            self.resize(height, width, *self.begin)
+        else:
+            self.cursor.y = min(self.cursor.y, self.height - 1)
+            self.cursor.x = min(self.cursor.x, self.width)
+
+            while self.offset + self.cursor.y >= len(self.lines):
+                self._insert_newline(real=False)
+
+        self.redraw = True
 
     def _ctl_attr(self, match):
-        s = match.group(1) or '0'
-        it = map(int, s.split(';'))
+        it = iter(params(match.group(1) or '0', default=0))
 
         try:
             while True:
@@ -676,7 +1420,7 @@ class ConsoleWindow(Window):
                         else:
                             r = g = b = (rgb - 232) * 256 // 23
                     else:
-                        log.error('Unknow control sequence %r', match.group(0))
+                        self._error('Unknow control sequence %r', match.group(0))
                         continue
 
                     if attr == 38:
@@ -706,49 +1450,61 @@ class ConsoleWindow(Window):
     def _ctl_cursor_home(self, match):
         y, x = 1, 1
         if match.group(1):
-            y, x = map(int, match.group(1).split(';'))
+            y, x = params(match.group(1))
 
         self._move_cursor_win(y - 1, x - 1)
 
     def _ctl_cursor_up(self, match):
-        offset = 1
-        if match.group(1):
-            offset = int(match.group(1))
+        offset = max(1, param(match.group(1)))
 
         self._move_cursor_win(max(0, self.cursor.y - offset), self.cursor.x)
 
     def _ctl_cursor_down(self, match):
-        offset = 1
-        if match.group(1):
-            offset = int(match.group(1))
+        offset = max(1, param(match.group(1)))
 
         self._move_cursor_win(min(self.height - 1, self.cursor.y + offset), self.cursor.x)
 
     def _ctl_cursor_forward(self, match):
-        offset = 1
-        if match.group(1):
-            offset = int(match.group(1))
+        offset = max(1, param(match.group(1)))
 
         self._move_cursor_win(self.cursor.y, min(self.width - 1, self.cursor.x + offset))
 
     def _ctl_cursor_backward(self, match):
-        offset = 1
-        if match.group(1):
-            offset = int(match.group(1))
+        offset = max(1, param(match.group(1)))
 
         self._move_cursor_win(self.cursor.y, max(0, self.cursor.x - offset))
 
+    def _ctl_tab_forward(self, match):
+        self._tab_forward(max(1, param(match.group(1))))
+
+    def _ctl_tab_backward(self, match):
+        self._tab_backward(max(1, param(match.group(1))))
+
+    def _ctl_set_tab_stop(self, match):
+        if self.cursor.x < self.width:
+            self.tab_stops[self.cursor.x] = 1
+            self._update_tab_stops()
+
+    def _ctl_clear_tab_stop(self, match):
+        mode = param(match.group(1), 0)
+
+        if mode == 0:
+            if self.cursor.x < self.width:
+                self.tab_stops[self.cursor.x] = 0
+        elif mode == 3:
+            self.tab_stops = bytearray(self.width)
+        else:
+            return
+
+        self._update_tab_stops()
+
     def _ctl_cursor_vertical_pos(self, match):
-        y = 1
-        if match.group(1):
-            y = int(match.group(1))
+        y = param(match.group(1))
 
         self._move_cursor_win(y - 1, self.cursor.x)
 
     def _ctl_cursor_horizontal_pos(self, match):
-        x = 1
-        if match.group(1):
-            x = int(match.group(1))
+        x = param(match.group(1))
 
         self._move_cursor_win(self.cursor.y, x - 1)
 
@@ -767,7 +1523,8 @@ class ConsoleWindow(Window):
         self.lines[y][0] = FormattedString()
 
         # update screen directly (only if the window won't be redraw completely)
-        if not self.redraw and self.display_offset <= y < self.display_offset + self.height:
+        if (self.win is not None and not self.redraw and
+                self.display_offset <= y < self.display_offset + self.height):
             add_formatted_str(self.win, y - self.display_offset, 0, FormattedString(' ' * self.width))
 
     def _ctl_erase_down(self, match):
@@ -775,7 +1532,14 @@ class ConsoleWindow(Window):
 
         # update buffer
         self.lines[y][0] = self.lines[y][0][:x]
-        self.lines = self.lines[:y + 1]
+        del self.lines[y + 1:]
+
+        # the numbers of the lines deleted are used again, and a real line
+        # erased from its start is not a prompt or an output anymore
+        num = self.lines[y][1]
+        if x > 0 or (y > 0 and self.lines[y - 1][1] == num):
+            num += 1
+        self._remove_marks_after(num)
         self.redraw = True
 
     def _ctl_erase_up(self, match):
@@ -792,21 +1556,16 @@ class ConsoleWindow(Window):
         self._ctl_erase_down(match)
 
     def _ctl_erase_char(self, match):
-        num = 1
-        if match.group(1):
-            num = int(match.group(1))
-
         y, x = self.offset + self.cursor.y, self.cursor.x
 
-        if x == self.width:
+        if x >= self.width:
             return
 
+        num = min(max(1, param(match.group(1))), self.width - x)
         self._update_line(y, x, ' ' * num)
 
     def _ctl_delete_line(self, match):
-        num = 1
-        if match.group(1):
-            num = int(match.group(1))
+        num = min(max(1, param(match.group(1))), self.height)
 
         if self.cursor.y > self.scroll_area[1]:
             return
@@ -814,15 +1573,12 @@ class ConsoleWindow(Window):
         saved_scroll_area = self.scroll_area
         self.scroll_area = (self.cursor.y, self.scroll_area[1])
 
-        for _ in range(num):
-            self._scroll_down(real=True)
+        self._scroll_down(real=True, num=num)
 
         self.scroll_area = saved_scroll_area
 
     def _ctl_insert_line(self, match):
-        num = 1
-        if match.group(1):
-            num = int(match.group(1))
+        num = min(max(1, param(match.group(1))), self.height)
 
         if self.cursor.y > self.scroll_area[1]:
             return
@@ -830,27 +1586,24 @@ class ConsoleWindow(Window):
         saved_scroll_area = self.scroll_area
         self.scroll_area = (self.cursor.y, self.scroll_area[1])
 
-        for _ in range(num):
-            self._scroll_up()
+        self._scroll_up(num)
 
         self.scroll_area = saved_scroll_area
 
     def _ctl_delete_char(self, match):
-        num = 1
-        if match.group(1):
-            num = int(match.group(1))
-
         y, x = self.offset + self.cursor.y, self.cursor.x
 
-        if x == self.width:
+        if x >= self.width:
             return
 
+        num = min(max(1, param(match.group(1))), self.width - x)
+
         self._update_line(y, x, self.lines[y][0][x + num:].ljust(self.width - x, ' '))
 
     def _ctl_scroll_area(self, match):
         top, down = 1, self.height
         if match.group(1):
-            top, down = map(int, match.group(1).split(';'))
+            top, down = (params(match.group(1)) + [self.height])[:2]
 
         down = max(min(down, self.height), 1)
         top = max(min(top, down), 1)
@@ -858,37 +1611,43 @@ class ConsoleWindow(Window):
         self.scroll_area = top - 1, down - 1
         self._move_cursor_win(0, 0)
 
-    def _scroll_down(self, real):
+    def _scroll_down(self, real, num=1):
+        '''Scroll the scroll area down by `num` lines
+
+        Arguments:
+            real(bool): Are the new lines real lines or just a line wrapped?
+            num(int): The number of lines
+        '''
         self.redraw = True
         area_top, area_down = self.scroll_area
 
         if area_top == 0 and area_down == self.height - 1: # usual scroll
-            self.offset += 1
+            num = min(num, self.height)
+            self.offset += num
 
             if self.auto_scroll:
                 self.display_offset = self.offset
 
-            if self.offset + self.cursor.y > len(self.lines) - 1:
-                self._insert_newline(real)
+            missing = self.offset + self.cursor.y - (len(self.lines) - 1)
+            if missing > 0:
+                self._insert_newline(real, missing)
         else:
-            area_down = min(area_down, len(self.lines) - 1 - self.offset)
-            for i in range(self.offset + area_top, self.offset + area_down):
-                self.lines[i] = copy.copy(self.lines[i + 1])
+            top = self.offset + area_top
+            down = min(self.offset + area_down, len(self.lines) - 1)
 
-            self.lines[self.offset + area_down][0] = FormattedString()
-            num = self.lines[self.offset + area_down - 1][1] if self.offset + area_down > 0 else 0
+            if down < top:
+                return
 
-            if real:
-                num += 1
-            self.lines[self.offset + area_down][1] = num
-            last = None
+            num = min(num, down - top + 1)
+            lines = self.lines[top + num:down + 1]
 
-            for i in range(self.offset + area_down + 1, len(self.lines)):
-                if last != self.lines[i][1]:
-                    num += 1
+            if real or not lines:
+                new_lines = [[FormattedString(), object()] for _ in range(num)]
+            else:
+                new_lines = [[FormattedString(), lines[-1][1]] for _ in range(num)]
 
-                last = self.lines[i][1]
-                self.lines[i][1] = num
+            self.lines[top:down + 1] = lines + new_lines
+            self._renumber_lines(top)
 
     def _ctl_scroll_down(self, match):
         if self.cursor.y != self.scroll_area[1]:
@@ -897,30 +1656,41 @@ class ConsoleWindow(Window):
 
         self._scroll_down(real=True)
 
-    def _scroll_up(self):
+    def _scroll_up(self, num=1):
+        '''Scroll the scroll area up by `num` lines'''
         self.redraw = True
         area_top, area_down = self.scroll_area
 
-        for i in range(min(self.offset + area_down - 1, len(self.lines) - 1),
-                       self.offset + area_top - 1,
-                       -1):
-            if i == len(self.lines) - 1: # last line
-                self.lines.append(copy.copy(self.lines[i]))
-            else:
-                self.lines[i + 1] = copy.copy(self.lines[i])
+        top = self.offset + area_top
+        down = self.offset + area_down
+        num = min(num, down - top + 1)
+
+        # the buffer can end within the scroll area, in which case it grows
+        new_lines = [[FormattedString(), object()] for _ in range(num)]
+        self.lines[top:down + 1] = (new_lines + self.lines[top:down + 1])[:down - top + 1]
+        self._renumber_lines(top)
+
+    def _renumber_lines(self, start):
+        '''Recompute the real line numbers of the lines after `start`
 
-        self.lines[self.offset + area_top][0] = FormattedString()
-        num = self.lines[self.offset + area_top - 1][1] + 1 if self.offset + area_top > 0 else 0
+        Consecutive lines sharing the same number (or placeholder) are
+        considered to be parts of the same real line.
+        '''
+        if start > 0:
+            num = last = self.lines[start - 1][1]
+        else:
+            num, last = -1, None
 
-        self.lines[self.offset + area_top][1] = num
-        last_num = None
+        self._remove_marks_after(num + 1)
 
-        for i in range(self.offset + area_top + 1, len(self.lines)):
-            if last_num != self.lines[i][1]:
+        for i in range(start, len(self.lines)):
+            line = self.lines[i]
+
+            if line[1] != last:
                 num += 1
 
-            last_num = self.lines[i][1]
-            self.lines[i][1] = num
+            last = line[1]
+            line[1] = num
 
     def _ctl_scroll_up(self, match):
         if self.cursor.y != self.scroll_area[0]:
@@ -930,10 +1700,12 @@ class ConsoleWindow(Window):
         self._scroll_up()
 
     def _ctl_application_keypad(self, match):
-        self.win.keypad(1)
+        if self.win is not None:
+            self.win.keypad(1)
 
     def _ctl_normal_keypad(self, match):
-        self.win.keypad(0)
+        if self.win is not None:
+            self.win.keypad(0)
 
     def _ctl_query_code(self, match):
         if not self.reply_query:
@@ -959,6 +1731,20 @@ class ConsoleWindow(Window):
 
         self.reply_query('\x1b[>84;0;0c')
 
+    def _ctl_query_private_mode(self, match):
+        if not self.reply_query:
+            return
+
+        num = param(match.group(1))
+        if num == 2004:
+            status = 1 if self.bracketed_paste else 2
+        elif num == 2026:
+            status = 1 if self.synchronized_update() else 2
+        else:
+            status = 0 # not recognized
+
+        self.reply_query('\x1b[?%d;%d$y' % (num, status))
+
     def scroll(self, offset):
         self.display_offset = min(max(self.display_offset + offset, 0), self.offset)
         self.auto_scroll = False # disable auto scroll
@@ -969,49 +1755,506 @@ class ConsoleWindow(Window):
         self.auto_scroll = True
         self.redraw = True
 
+    def scroll_to_prompt(self, direction):
+        '''Show the previous (direction < 0) or the next prompt at the top of the display window'''
+        if self.primary_screen is not None:
+            return
 
-class Process:
-    def __init__(self, args, env=None):
-        # validate parameters
-        if not isinstance(args, list):
-            args = [args]
+        # from the line of the cursor when not scrolling yet
+        y = self.display_offset if not self.auto_scroll else self.offset + self.cursor.y
+        num = self.lines[y][1]
+        if direction < 0:
+            i = bisect.bisect_left(self.prompt_marks, num) - 1
+        else:
+            i = bisect.bisect_right(self.prompt_marks, num)
 
-        env = env or os.environ
+        if 0 <= i < len(self.prompt_marks):
+            self.display_offset = min(self._index_mark(self.prompt_marks[i]), self.offset)
+            self.auto_scroll = False
+            self.redraw = True
 
-        # open a new pty
-        master, slave = pty.openpty()
+    def last_output(self):
+        '''Return the lines of the output of the last command, as (line, real number)
 
-        # launch subprocess
-        self.proc = subprocess.Popen(args=args,
-                                     env=env,
-                                     stdin=slave,
-                                     stdout=slave,
-                                     stderr=slave,
-                                     close_fds=True,
-                                     preexec_fn=self._preexec_fn)
+        The output starts at the last output mark and ends before the next
+        prompt, or at the cursor if the command is still running.
+        '''
+        if not self.output_marks or self.primary_screen is not None:
+            return []
 
-        self.proc.stdin = os.fdopen(os.dup(master), 'r+b', 0)
-        self.proc.stdout = os.fdopen(os.dup(master), 'r+b', 0)
-        self.proc.stderr = os.fdopen(os.dup(master), 'r+b', 0)
+        start = self.output_marks[-1]
+        i = bisect.bisect_right(self.prompt_marks, start)
 
-        os.close(master)
-        os.close(slave)
+        if i < len(self.prompt_marks):
+            end = self._index_mark(self.prompt_marks[i])
+        else:
+            end = self.offset + self.cursor.y + 1
 
-    @property
-    def pid(self):
-        return self.proc.pid
+        return [tuple(line) for line in self.lines[self._index_mark(start):end]]
+
+    def capture(self, start=0, end=None):
+        '''Return the lines of the real window from start to end (included)
+
+        Negative line numbers are lines of the history.
+        '''
+        end = self.height - 1 if end is None else end
+        first = max(0, self.offset + start)
+        last = min(len(self.lines), self.offset + end + 1)
+        return [line for line, _ in self.lines[first:last]]
+
+    def memory_usage(self):
+        '''Return an estimate of the memory used by the lines, in bytes
+
+        The history is counted once, only the lines of the real windows are
+        measured on each call.
+        '''
+        self._count_history()
+        lines = self.lines if self.primary_screen is None else self.primary_screen[0]
+        usage = self.history_bytes + sum(line.memory_size() + LINE_SIZE
+                                         for line, _ in lines[self.history_counted:])
+
+        if self.primary_screen is not None:
+            usage += sum(line.memory_size() + LINE_SIZE for line, _ in self.lines)
+
+        return usage
+
+    def _count_history(self):
+        '''Update the memory used by the history when its size changed'''
+        lines, offset = self.lines, self.offset
+        if self.primary_screen is not None:
+            lines, offset = self.primary_screen[:2]
+
+        counted = self.history_counted
+        if offset > counted:
+            self.history_bytes += sum(line.memory_size() + LINE_SIZE
+                                      for line, _ in lines[counted:offset])
+        elif offset < counted:
+            self.history_bytes -= sum(line.memory_size() + LINE_SIZE
+                                      for line, _ in lines[offset:counted])
+
+        self.history_counted = offset
+
+    def _uncount_history(self, lines, nb):
+        '''Update the memory used by the history before its first `nb` lines are removed'''
+        self._count_history()
+        self.history_bytes -= sum(line.memory_size() + LINE_SIZE for line, _ in lines[:nb])
+        self.history_counted -= nb
+
+    def metrics(self):
+        '''Return the counters of the emulation, see MetricsExporter'''
+        rows = len(self.lines)
+        if self.primary_screen is not None:
+            rows += len(self.primary_screen[0])
+
+        return {
+            'sequences': dict(self.sequences),
+            'unknown_sequences': self.unknown_sequences,
+            'write_time': (list(self.write_time.counts), self.write_time.sum),
+            'rows': rows,
+        }
+
+    def trim_history(self, size):
+        '''Remove the oldest lines of the history until `size` bytes are freed
+
+        The lines of the real window are kept, the history of the primary
+        screen is trimmed while the alternate screen is active. Returns the
+        number of bytes freed.
+        '''
+        lines, offset = self.lines, self.offset
+        if self.primary_screen is not None:
+            lines, offset = self.primary_screen[:2]
+
+        freed = 0
+        nb = 0
+        while nb < offset and freed < size:
+            freed += lines[nb][0].memory_size() + LINE_SIZE
+            nb += 1
+
+        if self.primary_screen is None:
+            self._remove_history(nb)
+        else:
+            self._uncount_history(lines, nb)
+            del lines[:nb]
+            self.primary_screen = (lines, offset - nb) + self.primary_screen[2:]
+            self._remove_marks(lines[0][1])
+
+        return freed
+
+    def _copy_primary_lines(self):
+        '''Return a copy of the lines of the primary screen, and its offset'''
+        if self.primary_screen is None:
+            lines, offset = self.lines, self.offset
+        else:
+            lines, offset = self.primary_screen[:2]
+
+        # only the lines of the real window are modified in place, and
+        # formatted strings are never modified
+        lines = list(lines)
+        for i in range(offset, len(lines)):
+            lines[i] = tuple(lines[i])
+
+        return lines, offset
+
+    def snapshot_lines(self):
+        '''Return a function returning the lines of the primary screen, and their width
+
+        The lines are copied, the function can be called from another thread.
+        '''
+        lines, _ = self._copy_primary_lines()
+        width = self.width if self.primary_screen is None else self.primary_screen[3][1]
+        return lambda: (lines, width)
+
+    def snapshot(self):
+        '''Capture the state of the primary screen
+
+        Returns a function encoding the state (see restore()), which can be
+        called from another thread.
+        '''
+        if self.primary_screen is None:
+            size = self.size
+            cursor = self.cursor.y, self.cursor.x
+            attr = self.attr, self.fg, self.bg
+        else:
+            _, _, _, size, saved_cursor = self.primary_screen
+
+            if saved_cursor:
+                cursor, attr = saved_cursor[:2], saved_cursor[2:]
+            else:
+                cursor = min(self.cursor.y, size[0] - 1), self.cursor.x
+                attr = self.attr, self.fg, self.bg
+
+        lines, offset = self._copy_primary_lines()
+
+        # output not emulated yet: the backlog, a control sequence or a
+        # character split between two reads, as bytes in a latin-1 string
+        pending = ((self.pending + self.backlog).encode('utf8') +
+                   self.decoder.getstate()[0]).decode('latin-1')
+        alternate = self.primary_screen is not None
+        bracketed_paste = self.bracketed_paste
+        marks = list(self.prompt_marks), list(self.output_marks)
+
+        return lambda: {
+            'size': size,
+            'offset': offset,
+            'cursor': cursor,
+            'attr': attr,
+            'first_line': lines[0][1],
+            'lines': encode_lines(lines),
+            'pending': pending,
+            'alternate': alternate,
+            'bracketed_paste': bracketed_paste,
+            'marks': marks,
+        }
+
+    def restore(self, state):
+        '''Restore the primary screen from a state returned by snapshot()'''
+        current_size = self.size
+
+        self.lines = decode_lines(state['lines'], state['first_line'])
+        self.offset = min(state['offset'], len(self.lines) - 1)
+        self.history_bytes = self.history_counted = 0
+        self.display_offset = self.offset
+        self.auto_scroll = True
+        self.primary_screen = None
+        self.cursor.y, self.cursor.x = state['cursor']
+        self.attr, self.fg, self.bg = state['attr']
+        self.prompt_marks, self.output_marks = map(list, state.get('marks', ([], [])))
+
+        # restore the previous size, then resize the lines if needed
+        self.size = tuple(state['size'])
+        self.scroll_area = 0, self.height - 1
+
+        while self.offset + self.cursor.y >= len(self.lines):
+            self._insert_newline(real=True)
+
+        if self.size != current_size:
+            self.resize(*current_size, *self.begin)
+
+        self._check_history_size()
+        self.redraw = True
+
+    def resume(self, state):
+        '''Restore the state of a console of the previous instance, after an upgrade
+
+        Unlike restore(), the process is the same: the alternate screen and
+        the modes are restored, and the output which was not emulated yet.
+        '''
+        self.restore(state)
+        self.bracketed_paste = state['bracketed_paste']
+
+        if state['alternate']:
+            self._enter_alternate_screen(save_cursor=True) # drawn again after SIGWINCH
+
+        self.write(state['pending'].encode('latin-1'))
+
+
+def encode_lines(lines):
+    '''Encode lines of a console into a compact list
+
+    A run of blank real lines is stored as its length. Other lines are
+    stored as [line number increment, elements...], where an element without
+    attributes is stored as its text only.
+    '''
+    encoded = []
+    last_num = lines[0][1]
+
+    for line, num in lines:
+        delta, last_num = num - last_num, num
+
+        if not line and delta == 1:
+            if encoded and isinstance(encoded[-1], int):
+                encoded[-1] += 1
+            else:
+                encoded.append(1)
+        else:
+            row = [delta]
+            for text, attr, fg, bg in line._elements:
+                row.append(text if (attr, fg, bg) == (0, -1, -1) else [text, attr, fg, bg])
+            encoded.append(row)
+
+    return encoded
+
+
+def decode_lines(encoded, num):
+    '''Decode lines encoded by encode_lines(), `num` is the number of the first line'''
+    lines = []
+
+    for row in encoded:
+        if isinstance(row, int):
+            for _ in range(row):
+                num += 1
+                lines.append([FormattedString(), num])
+        else:
+            num += row[0]
+            line = FormattedString()
+            line._elements = [(e, 0, -1, -1) if isinstance(e, str) else tuple(e)
+                              for e in row[1:]]
+            lines.append([line, num])
+
+    return lines
+
+
+HTML_COLORS = ('black', 'red', 'green', 'olive', 'navy', 'purple', 'teal', 'silver')
+
+SGR_ATTRIBUTES = ((curses.A_BOLD, 1),
+                  (curses.A_DIM, 2),
+                  (curses.A_UNDERLINE, 4),
+                  (curses.A_BLINK, 5),
+                  (curses.A_REVERSE, 7),
+                  (curses.A_INVIS, 8))
+
+
+def format_text(line):
+    return ''.join(text for text, _, _, _ in line._elements)
+
+
+def format_ansi(line):
+    out = []
+    styled = False
+
+    for text, attr, fg, bg in line._elements:
+        codes = ['0']
+        codes.extend(str(code) for flag, code in SGR_ATTRIBUTES if attr & flag)
+        if fg != -1:
+            codes.append(str(30 + fg) if fg < 8 else '38;5;%d' % fg)
+        if bg != -1:
+            codes.append(str(40 + bg) if bg < 8 else '48;5;%d' % bg)
+
+        if len(codes) > 1 or styled:
+            out.append('\x1b[%sm' % ';'.join(codes))
+            styled = len(codes) > 1
+
+        out.append(text)
+
+    if styled:
+        out.append('\x1b[0m')
+
+    return ''.join(out)
+
+
+def format_html(line):
+    out = []
+    for text, attr, fg, bg in line._elements:
+        if attr & curses.A_REVERSE:
+            fg, bg = (bg if bg != -1 else 7), (fg if fg != -1 else 0)
+
+        style = []
+        if 0 <= fg < 8:
+            style.append('color:%s' % HTML_COLORS[fg])
+        if 0 <= bg < 8:
+            style.append('background:%s' % HTML_COLORS[bg])
+        if attr & curses.A_BOLD:
+            style.append('font-weight:bold')
+        if attr & curses.A_UNDERLINE:
+            style.append('text-decoration:underline')
+
+        if style:
+            out.append('<span style="%s">%s</span>' % (';'.join(style), html.escape(text)))
+        else:
+            out.append(html.escape(text))
+
+    return ''.join(out)
+
+
+EXPORT_FORMATS = {
+    # format: (function formatting a line, header, footer)
+    'text': (format_text, '', ''),
+    'ansi': (format_ansi, '', ''),
+    'html': (format_html, '<pre style="background:white;color:black">\n', '</pre>\n'),
+}
+
+
+def export(lines, width, export_format='text'):
+    '''Generate the formatted lines of a console, one string at a time
+
+    `lines` are the lines of a console of that width, the rows of a wrapped
+    line are joined using their real line number.
+    '''
+    format_line, header, footer = EXPORT_FORMATS[export_format]
+    yield header
+
+    current, current_num = None, None
+    for line, num in lines:
+        if num == current_num:
+            # the rows are stored without their trailing spaces
+            padding = (width - len(current) % width) % width
+            current += FormattedString(' ' * padding)
+            current += line
+            continue
+
+        if current is not None:
+            yield format_line(current.rstrip()) + '\n'
+
+        current, current_num = line, num
+
+    if current is not None:
+        yield format_line(current.rstrip()) + '\n'
+
+    yield footer
+
+
+def export_file(path, lines, width, export_format='text'):
+    '''Write the lines of a console into a file, see export()'''
+    with open(path, 'w') as f:
+        for chunk in export(lines, width, export_format):
+            f.write(chunk)
+
+
+class Process:
+    min_read_size = 1024
+    max_read_size = 65536
+
+    def __init__(self, args, env=None):
+        # validate parameters
+        if not isinstance(args, list):
+            args = [args]
+
+        env = env or os.environ
+
+        # open a new pty
+        master, slave = pty.openpty()
+
+        # launch subprocess
+        import subprocess
+        self.proc = subprocess.Popen(args=args,
+                                     env=env,
+                                     stdin=slave,
+                                     stdout=slave,
+                                     stderr=slave,
+                                     close_fds=True,
+                                     preexec_fn=self._preexec_fn)
+
+        os.close(slave)
+        self._open_master(master)
+
+    @classmethod
+    def adopt(cls, pid, master):
+        '''Return the process started by the previous instance, after an upgrade
+
+        The process is still a child: exec() does not change the pid.
+        '''
+        self = cls.__new__(cls)
+        self.proc = AdoptedChild(pid)
+        self._open_master(master)
+        return self
+
+    def _open_master(self, master):
+        # a single non-blocking master, used for both reads and writes
+        os.set_blocking(master, False)
+        self.master = os.fdopen(master, 'r+b', 0)
+        self.read_buffer = bytearray(self.min_read_size)
+        self.write_queue = collections.deque()
 
     @property
-    def stdin(self):
-        return self.proc.stdin
+    def pid(self):
+        return self.proc.pid
 
     @property
-    def stdout(self):
-        return self.proc.stdout
+    def fd(self):
+        return self.master.fileno()
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, limit=None):
+        '''Read the available output of the process, without blocking
+
+        Returns a memoryview on the read buffer, valid until the next call, or
+        None if there is nothing to read. At most `limit` bytes are read.
+        '''
+        size = len(self.read_buffer)
+        n = self.master.readinto(memoryview(self.read_buffer)[:limit])
+
+        if not n:
+            return None
+
+        data = memoryview(self.read_buffer)[:n]
+
+        # adapt the size of the buffer to the throughput. A new buffer is
+        # allocated since the previous one is still referenced by `data`
+        if n == size and size < self.max_read_size:
+            self.read_buffer = bytearray(size * 2)
+        elif n < min(size, limit or size) // 8 and size > self.min_read_size:
+            self.read_buffer = bytearray(size // 2)
+
+        return data
+
+    def write(self, data):
+        '''Queue data for the process and write as much as possible, without blocking'''
+        if data:
+            self.write_queue.append(memoryview(data))
+            self.flush()
 
     @property
-    def stderr(self):
-        return self.proc.stderr
+    def pending_write(self):
+        return bool(self.write_queue)
+
+    def take_pending_write(self):
+        '''Return the data queued for the process, and forget them'''
+        data = b''.join(self.write_queue)
+        self.write_queue.clear()
+        return data
+
+    def flush(self):
+        '''Write the queued data until the pty is full'''
+        while self.write_queue:
+            data = self.write_queue[0]
+
+            try:
+                n = os.write(self.fd, data)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.write_queue.clear() # the process is gone
+                return
+
+            if n < len(data):
+                self.write_queue[0] = data[n:]
+            else:
+                self.write_queue.popleft()
+
+    def close(self):
+        self.master.close()
 
     def poll(self):
         return self.proc.poll()
@@ -1067,60 +2310,1943 @@ class Process:
             os.close(fd)
 
 
+class AdoptedChild:
+    '''The part of subprocess.Popen used by Process, for a child started
+    before exec()'''
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                self.returncode = -1 # reaped by someone else
+            else:
+                if pid:
+                    self.returncode = os.waitstatus_to_exitcode(status)
+
+        return self.returncode
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+
+def emulation_worker(conn, state_conn, height, width, history_size):
+    '''Main loop of the worker process of a WorkerConsoleWindow
+
+    The messages received are tuples (command, arguments...). After each
+    batch of messages, the lines of the display window that changed are sent
+    back to the main process, with the number of bytes written so far (the
+    main process stops reading the pty when too much output is not processed
+    yet, see WorkerConsoleWindow.can_write()). At most every
+    `stats_interval` seconds, the memory used by the lines and the metrics of
+    the emulation are sent with them.
+
+    Requests on `state_conn` are answered with the state of the console, the
+    elements of the lines captured, or the output of the last command. The
+    commands received before a request are processed before it is answered.
+
+    During a synchronized update, the lines are only sent at the end of the
+    frame.
+    '''
+    import multiprocessing.connection
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C is handled by the main process
+
+    console = ConsoleWindow(height, width, 0, 0, history_size, headless=True)
+    console.reply_query = lambda s: conn.send(('reply', s))
+    published = []
+    processed = acknowledged = 0 # bytes written
+    stats_time = 0 # last time the memory used and the metrics were sent
+    stale = False # commands processed since
+
+    while True:
+        try:
+            timeout = None
+            if console.synchronized_until is not None:
+                timeout = max(0, console.synchronized_until - time.monotonic())
+            elif stale: # send them even when no more commands come
+                timeout = max(0, stats_time + WorkerConsoleWindow.stats_interval - time.monotonic())
+
+            ready = multiprocessing.connection.wait([conn, state_conn], timeout)
+            commands = not ready # the end of a synchronized update
+
+            while conn.poll():
+                message = conn.recv()
+                command, args = message[0], message[1:]
+                commands = stale = True
+
+                if command == 'close':
+                    return
+                elif command == 'write':
+                    console.write(*args)
+                    processed += len(args[0])
+                elif command == 'resize':
+                    console.resize(*args)
+                elif command == 'scroll':
+                    console.scroll(*args)
+                elif command == 'disable_scroll':
+                    console.disable_scroll()
+                elif command == 'scroll_to_prompt':
+                    console.scroll_to_prompt(*args)
+                elif command == 'restore':
+                    console.restore(*args)
+                elif command == 'resume':
+                    console.resume(*args)
+                elif command == 'trim_history':
+                    console.trim_history(*args)
+                    stats_time = 0 # send the memory used now
+
+            if state_conn in ready:
+                request = state_conn.recv()
+
+                if request[0] == 'capture':
+                    state_conn.send([line._elements for line in console.capture(*request[1:])])
+                elif request[0] == 'last_output':
+                    state_conn.send([(line._elements, num) for line, num in console.last_output()])
+                else:
+                    state_conn.send(console.snapshot()())
+
+            if not commands:
+                continue
+        except EOFError:
+            return
+
+        if console.synchronized_update():
+            if processed != acknowledged:
+                conn.send(('ack', processed))
+                acknowledged = processed
+            continue
+
+        lines = [line._elements for line in console.display_lines()]
+        changes = [(y, line) for y, line in enumerate(lines)
+                   if y >= len(published) or published[y] != line]
+        published = lines
+
+        stats = None
+        now = time.monotonic()
+        if now - stats_time >= WorkerConsoleWindow.stats_interval:
+            stats = {'memory': console.memory_usage(), 'metrics': console.metrics()}
+            stats_time = now
+            stale = False
+
+        conn.send(('screen', changes, console.display_cursor(), console.auto_scroll,
+                   console.bracketed_paste, console.bell_count, processed, stats))
+        acknowledged = processed
+
+
+class WorkerConsoleWindow(Window):
+    '''A console window whose emulation runs in a worker process
+
+    The worker owns a headless ConsoleWindow fed with the output of the
+    process, and sends back the lines of the display window that changed.
+    This window only draws them.
+
+    The output sent but not processed by the worker yet is limited to
+    `max_unprocessed` bytes, which fit in the buffer of the pipe with the
+    other commands: the writes never block the main loop, and a slow worker
+    only delays its own pane.
+    '''
+    max_unprocessed = 32768 # half the buffer of a pipe on Linux
+    stats_interval = 1 # seconds between two updates of the stats, see emulation_worker()
+
+    def __init__(self, height, width, begin_y, begin_x, history_size, reply_query=None,
+                 headless=False):
+        super(WorkerConsoleWindow, self).__init__(height, width, begin_y, begin_x, headless)
+        self.reply_query = reply_query
+
+        import multiprocessing
+        context = multiprocessing.get_context('spawn')
+        self.conn, worker_conn = context.Pipe()
+        self.state_conn, worker_state_conn = context.Pipe()
+        self.state_lock = threading.Lock()
+        self.worker = context.Process(target=emulation_worker,
+                                      args=(worker_conn, worker_state_conn,
+                                            height, width, history_size),
+                                      daemon=True)
+        self.worker.start()
+        worker_conn.close()
+        worker_state_conn.close()
+
+        self.lines = [FormattedString()] * height
+        self.dirty = set()
+        self.cursor = Cursor(0, 0, visibility=1)
+        self.cursor_pos = (0, 0)
+        self.auto_scroll = True
+        self.bracketed_paste = False
+        self.bell_count = 0
+        self.sent = 0 # bytes written
+        self.processed = 0 # bytes processed by the worker
+        self.memory = 0 # memory used by the lines, sent by the worker
+        self.last_metrics = None # metrics of the emulation, sent by the worker
+        self.redraw = True
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def can_write(self):
+        '''Return True if the worker is ready for more output'''
+        return self.sent - self.processed < self.max_unprocessed
+
+    def write_limit(self):
+        '''Return the number of bytes which can be written without blocking'''
+        return self.max_unprocessed - (self.sent - self.processed)
+
+    def write(self, data, budget=None):
+        # the worker writes everything, the budget only applies to the main loop
+        self.conn.send(('write', bytes(data)))
+        self.sent += len(data)
+
+    def receive(self):
+        '''Apply the updates sent by the worker, return True if the screen changed'''
+        changed = False
+
+        while self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                break
+
+            if message[0] == 'reply':
+                if self.reply_query:
+                    self.reply_query(message[1])
+            elif message[0] == 'ack':
+                self.processed = message[1]
+            elif message[0] == 'screen':
+                (_, changes, self.cursor_pos, self.auto_scroll,
+                 self.bracketed_paste, bell_count, self.processed, stats) = message
+
+                if stats is not None:
+                    self.memory = stats['memory']
+                    self.last_metrics = stats['metrics']
+
+                # the lines mirror the lines published by the worker, even
+                # when they were published before a resize
+                for y, elements in changes:
+                    if y < len(self.lines):
+                        line = FormattedString()
+                        line._elements = elements
+                        self.lines[y] = line
+                        self.dirty.add(y)
+
+                if bell_count > self.bell_count and self.audible_bell:
+                    curses.beep()
+
+                self.bell_count = bell_count
+                changed = True
+
+        return changed
+
+    def resize(self, height, width, begin_y, begin_x):
+        super(WorkerConsoleWindow, self).resize(height, width, begin_y, begin_x)
+        self.lines = (self.lines + [FormattedString()] * height)[:height]
+        self.conn.send(('resize', height, width, begin_y, begin_x))
+        self.redraw = True
+
+    def scroll(self, offset):
+        self.auto_scroll = False
+        self.conn.send(('scroll', offset))
+
+    def disable_scroll(self):
+        self.auto_scroll = True
+        self.conn.send(('disable_scroll',))
+
+    def scroll_to_prompt(self, direction):
+        self.auto_scroll = False # until the worker sends the new display window
+        self.conn.send(('scroll_to_prompt', direction))
+
+    def snapshot(self):
+        '''Return a function fetching the state of the console from the worker'''
+        return self._fetch_state
+
+    def _request(self, *request):
+        '''Send a request on the state connection, return the answer of the worker'''
+        with self.state_lock:
+            self.state_conn.send(request)
+            return self.state_conn.recv()
+
+    def _fetch_state(self):
+        return self._request('snapshot')
+
+    def snapshot_lines(self):
+        '''Return a function fetching the lines of the primary screen from the worker'''
+        def fetch():
+            state = self._fetch_state()
+            return decode_lines(state['lines'], state['first_line']), state['size'][1]
+
+        return fetch
+
+    def capture(self, start=0, end=None):
+        lines = []
+
+        for elements in self._request('capture', start, end):
+            line = FormattedString()
+            line._elements = elements
+            lines.append(line)
+
+        return lines
+
+    def memory_usage(self):
+        return self.memory
+
+    def trim_history(self, size):
+        '''Ask the worker to trim its history, return an estimate of the bytes
+        freed (the worker sends the memory used after the trim)'''
+        self.conn.send(('trim_history', size))
+        freed = min(size, self.memory)
+        self.memory -= freed
+        return freed
+
+    def metrics(self):
+        '''Return the last metrics sent by the worker, or None'''
+        return self.last_metrics
+
+    def last_output(self):
+        lines = []
+
+        for elements, num in self._request('last_output'):
+            line = FormattedString()
+            line._elements = elements
+            lines.append((line, num))
+
+        return lines
+
+    def restore(self, state):
+        self.conn.send(('restore', state))
+
+    def resume(self, state):
+        self.conn.send(('resume', state))
+
+    def display_lines(self):
+        return [line.ljust(self.width, ' ') for line in self.lines]
+
+    def display_cursor(self):
+        return self.cursor_pos
+
+    def synchronized_update(self):
+        return False # the worker only sends complete frames
+
+    def refresh(self):
+        self.receive()
+
+        if self.redraw or self.dirty:
+            self.win.leaveok(1) # avoid cursor blinking
+
+            for y in range(self.height) if self.redraw else sorted(self.dirty):
+                add_formatted_str(self.win, y, 0, self.lines[y].ljust(self.width, ' '))
+
+            self.dirty.clear()
+            self.redraw = False
+            self.win.leaveok(0)
+
+        if self.cursor_pos:
+            self.win.move(*self.cursor_pos)
+
+        set_cursor_visibility(self.cursor, 1 if self.cursor_pos else 0)
+        self.win.refresh()
+
+    def close(self):
+        try:
+            self.conn.send(('close',))
+        except OSError:
+            pass
+
+        self.worker.join(1)
+        self.conn.close()
+        self.state_conn.close()
+
+
+ESCAPE_SEQUENCE = re.compile(rb'\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[()*+#%].|[^\[\]])')
+
+
+class PanePipe:
+    '''Stream the output of a pane to a file or a command
+
+    The output is queued and written by a background thread, in batches.
+
+    Arguments:
+        target(str): The path of a file, or a shell command if it starts with '|'
+        strip(bool): Remove the escape sequences from the output
+        policy(str): When the queue is full, either 'drop' the output or 'block'
+            until the writer catches up
+        max_size(int): The maximum number of bytes in the queue
+    '''
+    def __init__(self, target, strip=False, policy='drop', max_size=4 * 1024 * 1024):
+        assert policy in ('drop', 'block')
+        self.target = target
+        self.strip = strip
+        self.policy = policy
+        self.max_size = max_size
+
+        self.queue = collections.deque()
+        self.queued = 0 # number of bytes in the queue
+        self.dropped = 0 # number of bytes dropped
+        self.pending = b'' # incomplete escape sequence, when stripping
+        self.closed = False
+        self.condition = threading.Condition()
+
+        if target.startswith('|'):
+            import subprocess
+            self.proc = subprocess.Popen(target[1:], shell=True,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL,
+                                         start_new_session=True)
+            self.file = self.proc.stdin
+        else:
+            self.proc = None
+            self.file = open(os.path.expanduser(target), 'ab')
+
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def feed(self, data):
+        '''Queue the output of the pane'''
+        data = bytes(data)
+
+        if self.strip:
+            data = self._strip(data)
+
+        if not data:
+            return
+
+        with self.condition:
+            if self.policy == 'block':
+                while self.queued + len(data) > self.max_size and not self.closed:
+                    self.condition.wait()
+
+            if self.closed or self.queued + len(data) > self.max_size:
+                self.dropped += len(data)
+                return
+
+            self.queue.append(data)
+            self.queued += len(data)
+            self.condition.notify_all()
+
+    def _strip(self, data):
+        data = self.pending + data
+        self.pending = b''
+
+        # keep an escape sequence split between two reads for the next call
+        start = data.rfind(b'\x1b', max(0, len(data) - 256))
+        if start >= 0 and not ESCAPE_SEQUENCE.match(data, start):
+            data, self.pending = data[:start], data[start:]
+
+        return ESCAPE_SEQUENCE.sub(b'', data)
+
+    def _writer(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+
+                if not self.queue: # closed
+                    break
+
+                batch = b''.join(self.queue)
+                self.queue.clear()
+                self.queued = 0
+                self.condition.notify_all()
+
+            try:
+                self.file.write(batch)
+                self.file.flush()
+            except OSError as e:
+                log.error('pipe to %r failed: %s', self.target, e)
+
+                with self.condition:
+                    self.closed = True
+                    self.queue.clear()
+                    self.condition.notify_all()
+
+                break
+
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+        if self.proc is not None:
+            self.proc.wait()
+
+    def close(self, timeout=0):
+        '''Stop the pipe, once the queued output is written
+
+        Arguments:
+            timeout(float): Number of seconds to wait for the writer thread
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        if timeout:
+            self.thread.join(timeout)
+
+
+class OutputMonitor:
+    '''Watch the output of a pane for activity, silence and patterns
+
+    The patterns are compiled into a single regular expression, searched in
+    the text of the output once the control sequences are removed. A pattern
+    matches within a line: the end of the last line is kept and searched
+    again with the next output, only the matches not returned yet are
+    returned.
+
+    Arguments:
+        patterns(list): Regular expressions to search in the output
+        silence(float): Seconds without output after which the pane is
+            silent, or None
+    '''
+    max_carry = 4096 # longest end of line searched again with the next output
+
+    def __init__(self, patterns=(), silence=None):
+        self.patterns = list(patterns)
+        self.regex = None
+        if self.patterns:
+            self.regex = re.compile('|'.join('(?P<p%d>%s)' % (i, self.group(pattern))
+                                             for i, pattern in enumerate(self.patterns)))
+
+        self.silence = silence
+        self.silent = False
+        self.last_output = time.monotonic()
+        self.decoder = codecs.getincrementaldecoder('utf8')('replace')
+        self.carry = '' # end of the last line, without control sequences
+        self.matched = 0 # end of the last match returned in self.carry
+        self.pending = '' # control sequence split between two outputs
+
+    @staticmethod
+    def group(pattern):
+        '''Return the pattern as a group, its global flags ("(?i)...") become
+        flags of the group'''
+        flags = ''
+        match = GLOBAL_FLAGS.match(pattern)
+        while match:
+            flags += match.group(1)
+            pattern = pattern[match.end():]
+            match = GLOBAL_FLAGS.match(pattern)
+
+        if 'x' in flags:
+            pattern += '\n' # ends a comment at the end of the pattern
+
+        return '(?%s:%s)' % (flags, pattern)
+
+    def feed(self, data):
+        '''Search the patterns in the output, return the patterns which matched'''
+        self.last_output = time.monotonic()
+        self.silent = False
+
+        if self.regex is None:
+            return []
+
+        text = self.pending + self.decoder.decode(bytes(data))
+        self.pending = ''
+
+        escape = text.rfind('\x1b', max(0, len(text) - self.max_carry))
+        if escape != -1 and INCOMPLETE_SEQUENCE.fullmatch(text, escape):
+            text, self.pending = text[:escape], text[escape:][:self.max_carry]
+
+        start = len(self.carry)
+        text = self.carry + ANY_SEQUENCE.sub('', text)
+        matches = []
+        matched = self.matched
+
+        for match in self.regex.finditer(text):
+            # a match ending in the new output, not overlapping a match returned
+            if match.end() > start and match.start() >= self.matched:
+                matches.append(self.patterns[int(match.lastgroup[1:])])
+                matched = match.end()
+
+        self.carry = text[text.rfind('\n') + 1:][-self.max_carry:]
+        self.matched = max(0, matched - (len(text) - len(self.carry)))
+        return matches
+
+    def check_silence(self, now):
+        '''Return True when the pane becomes silent'''
+        if self.silence is None or self.silent or now - self.last_output < self.silence:
+            return False
+
+        self.silent = True
+        return True
+
+
+class Pane:
+    '''A process running in a console window
+
+    Arguments:
+        args: The command line of the process
+        worker(bool): Run the emulation in a worker process
+        proc(Process): The process, if it is already running
+        headless(bool): The console has no curses window (drawn by a renderer)
+    '''
+    # rows, a safety net: the history is limited by its memory, see ScreenManager.check_memory()
+    history_size = 50000
+    write_budget = 0.01 # seconds of emulation per read(), see ConsoleWindow.write()
+
+    def __init__(self, height, width, begin_y, begin_x, args, worker=False, proc=None,
+                 headless=False):
+        console_class = WorkerConsoleWindow if worker else ConsoleWindow
+        self.console = console_class(height, width, begin_y, begin_x, self.history_size,
+                                     headless=headless)
+        self.console.audible_bell = True # also when drawn by a renderer
+        self.proc = proc or Process(args)
+        self.name = os.path.basename(args[0] if isinstance(args, list) else args)
+        self.pipe = None
+        self.pending_refresh = False # output not refreshed yet, see read()
+        self.on_output = None # called with the output of the process
+        self.last_output = time.monotonic()
+        self.bytes_read = 0 # output read from the process, see MetricsExporter
+        self.memory_usage = 0 # memory used by the lines, see ScreenManager.check_memory()
+        self.refresh_time = Histogram() # refreshes of the screen showing the pane
+        self.monitor = None # see OutputMonitor
+        self.flags = set() # alerts shown in the list of windows, until it is selected
+        self.synchronized = False # receives the input typed in the other synchronized panes
+        self.id = None # number in the order of creation, see ScreenManager.new_pane()
+        self.console.reply_query = lambda s: self.proc.write(s.encode('utf8'))
+        self.update_size()
+
+    def fds(self):
+        '''Return the file descriptors to watch for the pane'''
+        # the output waits in the pty while the console is busy
+        fds = [self.proc.fd] if self.console.can_write() else []
+
+        if isinstance(self.console, WorkerConsoleWindow):
+            fds.append(self.console.fileno())
+
+        return fds
+
+    def has_backlog(self):
+        '''Return True if output read was not written to the console yet'''
+        return isinstance(self.console, ConsoleWindow) and bool(self.console.backlog)
+
+    def update_size(self):
+        set_hw(self.proc.fd, self.console.height, self.console.width)
+        self.proc.send_signal(signal.SIGWINCH)
+
+    def resize(self, height, width, begin_y, begin_x):
+        self.console.resize(height, width, begin_y, begin_x)
+        self.update_size()
+
+    def read(self):
+        '''Transfer the output of the process to the console
+
+        Returns True if the console needs to be refreshed. During a
+        synchronized update, the refresh is deferred to the end of the frame.
+
+        The emulation of the output is limited to `write_budget` seconds per
+        call, the output is not read until the backlog is written (or, with a
+        worker, while the worker is busy with the previous output).
+        '''
+        worker = isinstance(self.console, WorkerConsoleWindow)
+        backlog = self.has_backlog()
+
+        try:
+            data = self.proc.read(self.console.write_limit()) if self.console.can_write() else None
+        except OSError:
+            data = None
+
+        if data:
+            self.last_output = time.monotonic()
+            self.bytes_read += len(data)
+
+            if self.pipe:
+                self.pipe.feed(data)
+
+            if self.on_output:
+                self.on_output(data)
+
+            self.console.write(data, self.write_budget)
+        elif backlog:
+            self.console.write('', self.write_budget)
+
+        if worker:
+            return self.console.receive() # the worker only sends complete frames
+
+        self.pending_refresh |= bool(data) or backlog
+
+        if self.pending_refresh and not self.console.synchronized_update():
+            self.pending_refresh = False
+            return True
+
+        return False
+
+    def start_pipe(self, *args, **kwargs):
+        '''Stream the output to a file or a command, see PanePipe'''
+        self.stop_pipe()
+        self.pipe = PanePipe(*args, **kwargs)
+
+    def stop_pipe(self, timeout=0):
+        if self.pipe:
+            self.pipe.close(timeout)
+            self.pipe = None
+
+    def close(self):
+        self.stop_pipe(timeout=1)
+
+        if self.proc.poll() is None:
+            self.proc.kill()
+
+        self.proc.close()
+        self.console.close()
+
+
+def child_pids():
+    '''Return the pids of the children of this process (Linux only)'''
+    pids = []
+
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open('/proc/self/task/%s/children' % task) as f:
+                pids.extend(int(pid) for pid in f.read().split())
+    except OSError:
+        pass
+
+    return pids
+
+
+def write_file_atomic(path, data):
+    '''Write a file, readers see either the previous or the new content'''
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+class SessionSnapshot:
+    '''Save the windows and their history in a file, in a background thread'''
+    interval = 30 # seconds between two periodic snapshots
+
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.last_time = time.monotonic()
+
+    def save(self, panes):
+        '''Start saving the state of the panes, unless a save is in progress'''
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        # the states are captured now, and encoded in the background
+        jobs = [(pane.name, pane.console.snapshot()) for pane in panes]
+        self.thread = threading.Thread(target=self._write, args=(jobs,), daemon=True)
+        self.thread.start()
+        self.last_time = time.monotonic()
+
+    def _write(self, jobs):
+        windows = []
+        for name, job in jobs:
+            try:
+                windows.append({'name': name, 'console': job()})
+            except (OSError, EOFError) as e: # the worker died
+                log.error('unable to snapshot window %r: %s', name, e)
+
+        data = json.dumps({'version': 1, 'windows': windows}, separators=(',', ':'))
+        write_file_atomic(self.path, zlib.compress(data.encode('utf8'), 1))
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    def load(self):
+        '''Return the windows saved in the file, or an empty list'''
+        try:
+            with open(self.path, 'rb') as f:
+                session = json.loads(zlib.decompress(f.read()).decode('utf8'))
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError, zlib.error) as e:
+            log.error('unable to load the snapshot %r: %s', self.path, e)
+            return []
+
+        if session.get('version') != 1:
+            log.error('unknown snapshot version in %r', self.path)
+            return []
+
+        return session['windows']
+
+
+class Recorder:
+    '''Record the input, the output and the events of a session
+
+    Each line of the file is "<seconds since the start> <EVENT> <arguments>":
+        IN <data>: keys read from the terminal
+        OUT <window> <data>: output of the process of a window
+        SIZE <height> <width>: size of the terminal
+        SIGNAL <name>: signal received (WINCH, CONT, INT, USR2)
+        WINDOW <window>, NEW <window>, CLOSE <window>: window selected,
+            created or closed
+
+    The windows are identified by their id (Pane.id), which is their number
+    in the order of creation and does not change when a window is closed.
+
+    The data are JSON strings, the bytes which are not utf-8 are escaped as
+    surrogates. The time is monotonic. The writes are buffered, the file is
+    flushed by the main loop every `flush_interval` seconds.
+    '''
+    version = 2
+    flush_interval = 1
+
+    def __init__(self, path, start=None):
+        self.last_flush = time.monotonic()
+
+        if start is not None: # the recording of the previous instance, after an upgrade
+            self.file = open(path, 'a', buffering=256 * 1024)
+            self.start = start
+            return
+
+        self.file = open(path, 'w', buffering=256 * 1024)
+        self.start = self.last_flush
+        self.file.write('# pytmux recording %d %s\n' % (self.version,
+                                                         time.strftime('%Y-%m-%dT%H:%M:%S%z')))
+
+    def record(self, event, *args):
+        self.file.write('%.6f %s %s\n' % (time.monotonic() - self.start, event,
+                                          ' '.join(map(str, args))))
+
+    def data(self, data):
+        return json.dumps(bytes(data).decode('utf8', 'surrogateescape'))
+
+    def input(self, data):
+        self.record('IN', self.data(data))
+
+    def output(self, window, data):
+        self.record('OUT', window, self.data(data))
+
+    def flush(self):
+        now = time.monotonic()
+
+        if now - self.last_flush > self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
+
+
+class MetricsExporter:
+    '''Export the metrics of the windows in the Prometheus text format
+
+    The metrics are collected by the main loop every `interval` seconds. They
+    are written into a file, e.g. for the textfile collector of
+    node_exporter, and/or served on a Unix socket by a thread: each client
+    receives the last metrics, as an HTTP response if it sent an HTTP request.
+    '''
+    interval = 5 # seconds between two collections of the metrics
+    request_timeout = 0.1 # time given to the clients to send a request
+
+    families = (
+        ('bytes_read_total', 'counter', 'Bytes of output read from the process of the window'),
+        ('sequences_total', 'counter', 'Control sequences handled, by type'),
+        ('unknown_sequences_total', 'counter', 'Control sequences skipped, unknown or malformed'),
+        ('parse_seconds', 'histogram', 'Time to parse each read of output of the window'),
+        ('refresh_seconds', 'histogram', 'Duration of the refreshes of the screen, by window shown'),
+        ('scrollback_rows', 'gauge', 'Lines of the window, history included'),
+        ('scrollback_bytes', 'gauge', 'Estimate of the memory used by the lines of the window'),
+        ('main_loop_seconds', 'histogram', 'Duration of the iterations of the main loop, '
+                                           'without the wait'),
+    )
+
+    def __init__(self, path=None, socket_path=None):
+        self.path = path
+        self.socket_path = socket_path
+        self.text = ''
+        self.last_time = 0
+        self.server = None
+
+        if socket_path:
+            import socket
+
+            if os.path.exists(socket_path):
+                os.unlink(socket_path) # stale socket
+
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(socket_path)
+            os.chmod(socket_path, 0o600)
+            self.server.listen()
+            threading.Thread(target=self._serve, daemon=True).start()
+
+    def update(self, manager):
+        '''Collect the metrics of the screen manager, from the main loop'''
+        self.last_time = time.monotonic()
+        self.text = self.format(manager)
+
+        if self.path:
+            try:
+                write_file_atomic(self.path, self.text.encode('utf8'))
+            except OSError as e:
+                log.error('unable to write the metrics: %s', e)
+
+    def format(self, manager):
+        samples = {name: [] for name, _, _ in self.families}
+
+        for pane in manager.panes:
+            # the stable id: the series of a window do not move when another one closes
+            labels = 'window="%d",name="%s"' % (pane.id, self._escape(pane.name))
+            samples['bytes_read_total'].append('{%s} %d' % (labels, pane.bytes_read))
+            samples['refresh_seconds'] += self._histogram(labels, pane.refresh_time.counts,
+                                                          pane.refresh_time.sum)
+            samples['scrollback_bytes'].append('{%s} %d' % (labels, pane.memory_usage))
+
+            metrics = pane.console.metrics()
+            if metrics is None: # not sent by the worker yet
+                continue
+
+            for name, count in sorted(metrics['sequences'].items()):
+                samples['sequences_total'].append('{%s,type="%s"} %d' % (
+                    labels, name[len('_ctl_'):], count))
+
+            samples['unknown_sequences_total'].append('{%s} %d' % (
+                labels, metrics['unknown_sequences']))
+            samples['parse_seconds'] += self._histogram(labels, *metrics['write_time'])
+            samples['scrollback_rows'].append('{%s} %d' % (labels, metrics['rows']))
+
+        samples['main_loop_seconds'] += self._histogram('', manager.loop_time.counts,
+                                                        manager.loop_time.sum)
+
+        text = []
+        for name, metric_type, description in self.families:
+            text.append('# HELP pytmux_%s %s\n' % (name, description))
+            text.append('# TYPE pytmux_%s %s\n' % (name, metric_type))
+            text.extend('pytmux_%s%s\n' % (name, sample) for sample in samples[name])
+
+        return ''.join(text)
+
+    @staticmethod
+    def _escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _histogram(labels, counts, total):
+        '''Return the samples of a histogram, with cumulative buckets'''
+        prefix = labels + ',' if labels else ''
+        labels = '{%s}' % labels if labels else ''
+        samples = []
+        count = 0
+
+        for bound, bucket_count in zip(Histogram.buckets + ('+Inf',), counts):
+            count += bucket_count
+            samples.append('_bucket{%sle="%s"} %d' % (prefix, bound, count))
+
+        samples.append('_sum%s %.6f' % (labels, total))
+        samples.append('_count%s %d' % (labels, count))
+        return samples
+
+    def _serve(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+            except OSError: # closed
+                return
+
+            with client:
+                try:
+                    request = b''
+                    if select.select([client], [], [], self.request_timeout)[0]:
+                        request = client.recv(65536)
+
+                    data = self.text.encode('utf8')
+                    if b' HTTP/' in request.split(b'\n', 1)[0]:
+                        data = (b'HTTP/1.0 200 OK\r\n'
+                                b'Content-Type: text/plain; version=0.0.4\r\n'
+                                b'Content-Length: %d\r\n\r\n' % len(data)) + data
+
+                    client.sendall(data)
+                except OSError:
+                    pass
+
+    def close(self):
+        if self.server is None:
+            return
+
+        import socket
+
+        try:
+            self.server.shutdown(socket.SHUT_RDWR) # wakes up accept()
+        except OSError:
+            pass
+
+        self.server.close()
+
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+PIPE_TARGET = '~/pytmux-window-{window}.log'
+EXPORT_TARGET = '~/pytmux-export-{window}.txt'
+
+
+KEY_NAMES = {
+    'Enter': '\r', 'Tab': '\t', 'Escape': '\x1b', 'Space': ' ', 'BSpace': '\x7f',
+    'Up': '\x1b[A', 'Down': '\x1b[B', 'Right': '\x1b[C', 'Left': '\x1b[D',
+    'Home': '\x1b[H', 'End': '\x1b[F', 'PageUp': '\x1b[5~', 'PageDown': '\x1b[6~',
+}
+
+
+def key_bytes(keys):
+    '''Convert the keys of a send-keys command into bytes
+
+    `keys` is either a string sent as is, or a list of key names (Enter,
+    C-c, ...) and strings.
+    '''
+    if isinstance(keys, str):
+        return keys.encode('utf8')
+
+    data = []
+    for key in keys:
+        if key in KEY_NAMES:
+            data.append(KEY_NAMES[key])
+        elif len(key) == 3 and key.startswith('C-'):
+            data.append(chr(ord(key[2]) & 0x1f))
+        else:
+            data.append(key)
+
+    return ''.join(data).encode('utf8')
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer:
+    '''Serve the control API on a Unix socket
+
+    The server runs an asyncio loop in a thread. Requests are JSON lines
+    {"id": ..., "cmd": ..., arguments...}, answered with a JSON line with the
+    same id and either the result or an error. Clients can also subscribe to
+    events, sent as JSON lines {"event": ..., arguments...}.
+
+    The commands touching the windows are queued and run by the main loop,
+    which is woken up through fileno() and calls process().
+    '''
+    events = ('output', 'window-new', 'window-close', 'window-select', 'alert')
+    max_buffer_size = 1024 * 1024 # events are dropped for slower clients
+    poll_interval = 0.1 # for wait-for, the emulation of workers is asynchronous
+
+    def __init__(self, path, manager):
+        import asyncio
+        self.path = path
+        self.manager = manager
+        self.calls = collections.deque() # (function, arguments, future) run by the main loop
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+
+        self.subscribers = {} # writer -> events
+        self.changed = {} # pane -> asyncio.Event set on its next output
+
+        if os.path.exists(path):
+            os.unlink(path) # stale socket
+
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            asyncio.start_unix_server(self._client, path, limit=16 * 1024 * 1024))
+        os.chmod(path, 0o600)
+
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def fileno(self):
+        return self.wake_r
+
+    def process(self):
+        '''Run the queued commands, from the main loop'''
+        try:
+            while os.read(self.wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.calls:
+            function, args, future = self.calls.popleft()
+
+            try:
+                result, error = function(*args), None
+            except ControlError as e:
+                result, error = None, e
+            except Exception as e:
+                log.exception('control command failed')
+                result, error = None, ControlError(str(e))
+
+            self.loop.call_soon_threadsafe(self._resolve, future, result, error)
+
+    @staticmethod
+    def _resolve(future, result, error):
+        if future.done(): # cancelled
+            return
+
+        if error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def emit(self, event, **kwargs):
+        '''Send an event to the subscribers, from the main loop'''
+        if self.subscribers:
+            self.loop.call_soon_threadsafe(self._dispatch, dict(kwargs, event=event))
+
+    def output(self, pane, data):
+        '''Called by the main loop with the output of a pane'''
+        if self.changed:
+            self.loop.call_soon_threadsafe(self._set_changed, pane)
+
+        if self.subscribers:
+            index = self.manager.panes.index(pane)
+            self.emit('output', window=index, data=bytes(data).decode('utf8', 'replace'))
+
+    def _set_changed(self, pane):
+        changed = self.changed.pop(pane, None)
+        if changed:
+            changed.set()
+
+    def _dispatch(self, message):
+        line = (json.dumps(message) + '\n').encode()
+
+        for writer, events in self.subscribers.items():
+            if message['event'] in events:
+                if writer.transport.get_write_buffer_size() < self.max_buffer_size:
+                    writer.write(line)
+
+    async def _call(self, function, *args):
+        '''Run the function in the main loop'''
+        future = self.loop.create_future()
+        self.calls.append((function, args, future))
+
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:
+            pass # already woken up
+
+        return await future
+
+    async def _client(self, reader, writer):
+        tasks = set()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                task = self.loop.create_task(self._request(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (ConnectionError, ValueError) as e:
+            log.error('control client: %s', e)
+        finally:
+            self.subscribers.pop(writer, None)
+
+            for task in tasks:
+                task.cancel()
+
+            writer.close()
+
+    async def _request(self, line, writer):
+        request_id = None
+
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('not a JSON object')
+
+            request_id = request.get('id')
+            handler = getattr(self, '_cmd_' + str(request.get('cmd')).replace('-', '_'), None)
+
+            if handler is None:
+                raise ControlError('unknown command %r' % request.get('cmd'))
+
+            response = {'id': request_id, 'result': await handler(writer, **{
+                key: value for key, value in request.items() if key not in ('id', 'cmd')})}
+        except ControlError as e:
+            response = {'id': request_id, 'error': str(e)}
+        except (ValueError, TypeError, re.error) as e: # invalid json, arguments or pattern
+            response = {'id': request_id, 'error': 'invalid request: %s' % e}
+
+        writer.write((json.dumps(response) + '\n').encode())
+
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+    def _pane(self, window):
+        panes = self.manager.panes
+
+        if window is None:
+            return self.manager.pane
+
+        if not isinstance(window, int) or not 0 <= window < len(panes):
+            raise ControlError('no window %r' % window)
+
+        return panes[window]
+
+    async def _capture(self, window, start, end, attributes):
+        pane = await self._call(self._pane, window)
+
+        if isinstance(pane.console, WorkerConsoleWindow):
+            # a round trip to the worker, which does not block the main loop
+            try:
+                lines = await self.loop.run_in_executor(None, pane.console.capture, start, end)
+            except (OSError, EOFError) as e:
+                raise ControlError('window closed: %s' % e)
+        else:
+            lines = await self._call(pane.console.capture, start, end)
+
+        if attributes:
+            return [[list(element) for element in line._elements] for line in lines]
+        else:
+            return [''.join(text for text, _, _, _ in line._elements).rstrip() for line in lines]
+
+    async def _cmd_list_windows(self, writer):
+        def list_windows():
+            return [{'index': i,
+                     'name': pane.name,
+                     'pid': pane.proc.pid,
+                     'current': i == self.manager.current,
+                     'size': pane.console.size,
+                     'memory': pane.memory_usage,
+                     'synchronized': pane.synchronized}
+                    for i, pane in enumerate(self.manager.panes)]
+
+        return await self._call(list_windows)
+
+    async def _cmd_new_window(self, writer):
+        def new_window():
+            self.manager.new_pane()
+            return self.manager.current
+
+        return await self._call(new_window)
+
+    async def _cmd_select_window(self, writer, window):
+        def select_window():
+            self._pane(window)
+            self.manager.select_pane(window)
+
+        return await self._call(select_window)
+
+    async def _cmd_send_keys(self, writer, keys, window=None):
+        data = key_bytes(keys)
+        await self._call(lambda: self._pane(window).proc.write(data))
+
+    async def _cmd_capture_pane(self, writer, window=None, start=0, end=None, attributes=False):
+        return await self._capture(window, start, end, attributes)
+
+    async def _cmd_export_pane(self, writer, path, window=None, format='text'):
+        if format not in EXPORT_FORMATS:
+            raise ControlError('unknown format %r' % format)
+
+        path = os.path.expanduser(path)
+        lines = await self._call(lambda: self._pane(window).console.snapshot_lines())
+
+        try:
+            await self.loop.run_in_executor(None, lambda: export_file(path, *lines(), format))
+        except OSError as e:
+            raise ControlError(str(e))
+
+        return path
+
+    async def _cmd_wait_for(self, writer, pattern, window=None, timeout=10, start=0, end=None):
+        '''Wait until the lines from start to end match the pattern'''
+        import asyncio
+        regex = re.compile(pattern, re.MULTILINE)
+        deadline = self.loop.time() + timeout
+        pane = await self._call(self._pane, window)
+
+        while True:
+            changed = self.changed.setdefault(pane, asyncio.Event())
+            lines = await self._capture(window, start, end, False)
+            match = regex.search('\n'.join(lines))
+
+            if match:
+                return {'match': match.group(0), 'groups': match.groups()}
+
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                raise ControlError('timeout')
+
+            try:
+                await asyncio.wait_for(changed.wait(), min(remaining, self.poll_interval))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _cmd_subscribe(self, writer, events=events):
+        unknown = set(events) - set(self.events)
+        if unknown:
+            raise ControlError('unknown events %s' % ', '.join(sorted(unknown)))
+
+        self.subscribers.setdefault(writer, set()).update(events)
+
+    async def _cmd_unsubscribe(self, writer, events=events):
+        self.subscribers.get(writer, set()).difference_update(events)
+
+    def close(self):
+        def stop():
+            self.server.close()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(stop)
+        self.thread.join(1)
+
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+
+# runs the new instance as a module, from its cached bytecode, see ScreenManager.upgrade()
+UPGRADE_BOOTSTRAP = '''
+import runpy, sys
+path, name = sys.argv[1:3]
+del sys.argv[1:3]
+sys.path.insert(0, path)
+runpy.run_module(name, run_name='__main__', alter_sys=True)
+'''
+
+
 class ScreenManager:
-    def __init__(self, screen):
-        height, width = get_hw(sys.stdout)
+    memory_interval = 1 # seconds between two checks of the memory used by the history
+    alert_duration = 10 # seconds the last alert is shown in the banner
+    alert_flags = {'activity': '#', 'silence': '~', 'pattern': '!'}
+
+    def __init__(self, screen, workers=False, snapshot_dir=None,
+                 pipe_target=PIPE_TARGET, pipe_strip=False, pipe_policy='drop',
+                 renderer='curses', control_socket=None, record=None, history_memory=None,
+                 monitor_activity=False, monitor_silence=None, monitor_patterns=(),
+                 metrics_file=None, metrics_socket=None, resume=None):
         self.screen = screen
-        self.banner = BannerWindow(1, width, height - 1, 0)
-        self.console = ConsoleWindow(height - 1, width, 0, 0, 200)
+        self.workers = workers
+        self.resumed = self.receive_upgrade(resume) if resume is not None else None
+        self.orphans = set() # pids to wait for, see resume_panes()
+        self.renderer = AnsiRenderer(sys.stdout.fileno()) if renderer == 'ansi' else None
+        self.pipe_options = pipe_target, pipe_strip, pipe_policy
+        self.snapshot = None
+
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            self.snapshot = SessionSnapshot(os.path.join(snapshot_dir, 'session.snapshot'))
+        self.panes = []
+        self.current = 0
+        self.next_pane_id = 0
+
+        height, width = get_hw(sys.stdout)
+        self.banner = BannerWindow(1, width, height - 1, 0, segments={
+            'windows': StatusSegment(self.window_list, interval=0),
+            'memory': StatusSegment(self.memory_status, interval=self.memory_interval),
+            'alert': StatusSegment(self.alert_status, interval=0),
+        }, headless=self.renderer is not None)
         self.resize_event = False
         self.int_event = False
+        self.upgrade_event = False
         self.console_key = False
+        self.paste = None # state of the paste in progress
+        self.control = ControlServer(control_socket, self) if control_socket else None
+        self.recorder = None
+        if record:
+            self.recorder = Recorder(record, self.resumed and self.resumed[0]['recorder_start'])
+        self.signals = collections.deque() # signals received, to record
+        self.history_memory = history_memory # budget of all the lines, in bytes
+        self.memory_usage = 0
+        self.memory_time = 0
+        self.monitor_activity = monitor_activity
+        self.monitor_options = monitor_patterns, monitor_silence
+        self.alert = None # (time, message) of the last alert
+        self.metrics = None
+        if metrics_file or metrics_socket:
+            self.metrics = MetricsExporter(metrics_file, metrics_socket)
+        self.loop_time = Histogram() # iterations of the main loop
+        self.paste_buffer = b'' # see copy_last_output()
+
+    @property
+    def pane(self):
+        return self.panes[self.current]
+
+    @property
+    def console(self):
+        return self.pane.console
+
+    @property
+    def proc(self):
+        return self.pane.proc
+
+    def window_list(self):
+        return '[0] ' + ' '.join('%d:%s%s%s' % (i, pane.name,
+                                                '*' if i == self.current else ''.join(sorted(pane.flags)),
+                                                '=' if pane.synchronized else '')
+                                 for i, pane in enumerate(self.panes))
+
+    def alert_status(self):
+        if self.alert and time.monotonic() - self.alert[0] < self.alert_duration:
+            return self.alert[1]
+        return ''
+
+    def new_pane(self, args=None, proc=None, pane_id=None):
+        '''Create a pane, `pane_id` is the id of a pane of the previous instance'''
+        height, width = get_hw(sys.stdout)
+        pane = Pane(height - 1, width, 0, 0,
+                    args or os.environ.get('SHELL', '/bin/sh'),
+                    worker=self.workers, proc=proc, headless=self.renderer is not None)
+        self.panes.append(pane)
+
+        pane.id = self.next_pane_id if pane_id is None else pane_id
+        self.next_pane_id = max(self.next_pane_id, pane.id + 1)
+
+        patterns, silence = self.monitor_options
+        if patterns or silence is not None:
+            pane.monitor = OutputMonitor(patterns, silence)
+
+        if self.control or self.recorder or pane.monitor or self.monitor_activity:
+            pane.on_output = functools.partial(self.pane_output, pane)
+
+        if self.control:
+            self.control.emit('window-new', window=len(self.panes) - 1)
+
+        if self.recorder and pane_id is None: # else recorded by the previous instance
+            self.recorder.record('NEW', pane.id)
+
+        self.select_pane(len(self.panes) - 1)
+
+    def restore_panes(self):
+        '''Create the panes, from the previous instance after an upgrade, or
+        from the snapshot if there is one'''
+        if self.resumed:
+            self.resume_panes()
+            return
+
+        windows = self.snapshot.load() if self.snapshot else []
+
+        for window in windows:
+            self.new_pane()
+            self.console.restore(window['console'])
+            self.console.write(b'\r\n') # the new shell starts below the history
+
+        if not windows:
+            self.new_pane()
+
+        self.select_pane(0)
+
+    def upgrade(self):
+        '''Execute tmux.py again, the new instance takes over the windows
+
+        The state of the windows is written into an unlinked file. Its
+        descriptor and the masters of the ptys are sent over a socket
+        inherited by the new instance (SCM_RIGHTS), see receive_upgrade().
+        The output which was not read yet stays in the ptys, the input not
+        written yet is written by the new instance, and the shells stay
+        children of the same pid.
+        '''
+        import importlib.util
+        import socket
+        import tempfile
+
+        script = os.path.abspath(sys.argv[0])
+        name = os.path.splitext(os.path.basename(script))[0]
+        try:
+            if not os.access(sys.executable, os.X_OK):
+                raise OSError('cannot execute %s' % sys.executable)
+
+            # check the new code, and cache its bytecode for the new instance
+            importlib.util.spec_from_file_location(name, script).loader.get_code(name)
+        except (OSError, SyntaxError) as e:
+            log.error('upgrade aborted: %s', e)
+            self.alert = time.monotonic(), 'upgrade failed: %s' % e
+            return
+
+        log.info('upgrading')
+        if self.snapshot:
+            self.snapshot.wait()
+
+        for pane in self.panes:
+            pane.proc.flush()
+
+        state = {
+            'version': 1,
+            'time': time.time(),
+            'current': self.current,
+            'recorder_start': self.recorder.start if self.recorder else None,
+            'windows': [{'name': pane.name, 'pid': pane.proc.pid, 'id': pane.id,
+                         'synchronized': pane.synchronized,
+                         'input': pane.proc.take_pending_write().decode('latin-1'),
+                         'console': pane.console.snapshot()()} for pane in self.panes],
+        }
+
+        state_file = tempfile.TemporaryFile()
+        state_file.write(json.dumps(state, separators=(',', ':')).encode('utf8'))
+        state_file.seek(0)
+
+        sender, receiver = socket.socketpair()
+        socket.send_fds(sender, [b'upgrade'],
+                        [state_file.fileno()] + [pane.proc.fd for pane in self.panes])
+        sender.close()
+        state_file.close()
+        receiver.set_inheritable(True)
+
+        # release what the new instance takes over, but keep the processes
+        if self.control:
+            self.control.close()
+
+        if self.recorder:
+            self.recorder.close()
+
+        if self.metrics:
+            self.metrics.close()
+
+        for pane in self.panes:
+            pane.stop_pipe(timeout=1)
+            pane.console.close()
+
+        self.control = self.recorder = self.metrics = self.snapshot = None
+
+        argv = list(sys.argv)
+        if '--resume' in argv:
+            i = argv.index('--resume')
+            del argv[i:i + 2]
+
+        curses.reset_shell_mode() # the modes saved by the new instance
+        try:
+            os.execv(sys.executable, [sys.executable, '-c', UPGRADE_BOOTSTRAP, os.path.dirname(script),
+                                      name] + argv[1:] + ['--resume', str(receiver.fileno())])
+        except OSError as e:
+            # the windows were released, exit like on the last window closed
+            log.error('upgrade failed: %s', e)
+            raise SystemExit('error: upgrade failed: %s' % e)
+
+    @staticmethod
+    def receive_upgrade(fd):
+        '''Return the state sent by upgrade(), and the masters of the ptys'''
+        import socket
+
+        with socket.socket(fileno=fd) as sock:
+            _, fds, _, _ = socket.recv_fds(sock, 1024, 1024)
+
+        with os.fdopen(fds[0], 'rb') as f:
+            state = json.loads(f.read().decode('utf8'))
+
+        return state, fds[1:]
+
+    def resume_panes(self):
+        '''Create the panes of the processes of the previous instance'''
+        state, masters = self.resumed
+        self.resumed = None
+
+        # the other children of the previous instance, e.g. the resource
+        # tracker of its workers, exit after the exec and are reaped later
+        self.orphans = set(child_pids()) - {window['pid'] for window in state['windows']}
+
+        for window, master in zip(state['windows'], masters):
+            self.new_pane(window['name'], Process.adopt(window['pid'], master),
+                          window.get('id'))
+            self.pane.synchronized = window.get('synchronized', False)
+            self.console.resume(window['console'])
+            self.pane.proc.write(window.get('input', '').encode('latin-1'))
+
+        if not self.panes:
+            self.new_pane()
+
+        self.select_pane(min(state['current'], len(self.panes) - 1))
+        log.info('upgraded in %.0fms', (time.time() - state['time']) * 1000)
+
+    def reap_orphans(self):
+        '''Wait for the children left by the previous instance which exited'''
+        for pid in list(self.orphans):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                pass
+
+            self.orphans.discard(pid)
+
+    def select_pane(self, index):
+        if self.panes and self.current < len(self.panes):
+            self.console.redraw = True # hidden consoles are not drawn
+
+        self.current = index
+        self.pane.flags.clear()
+        self.console.redraw = True
+        self.console.cursor.visibility = -1 # the cursor is shared by all consoles
+        self.refresh()
+
+        if self.control:
+            self.control.emit('window-select', window=index)
+
+        if self.recorder:
+            self.recorder.record('WINDOW', self.pane.id)
+
+    def remove_pane(self, pane):
+        index = self.panes.index(pane)
+        self.panes.remove(pane)
+        pane.close()
+
+        if self.control:
+            self.control.emit('window-close', window=index)
+
+        if self.recorder:
+            self.recorder.record('CLOSE', pane.id)
+
+        if self.panes:
+            if index < self.current or self.current == len(self.panes):
+                self.current -= 1
+
+            self.select_pane(self.current)
+
+    def check_memory(self):
+        '''Measure the memory used by the lines of the panes, and evict
+        history when it is over the budget
+
+        The history of the coldest and largest panes is evicted first: the
+        panes are sorted by their size multiplied by the time since their
+        last output. The current pane comes last.
+        '''
+        now = time.monotonic()
+        self.memory_time = now
+
+        for pane in self.panes:
+            pane.memory_usage = pane.console.memory_usage()
+
+        self.memory_usage = sum(pane.memory_usage for pane in self.panes)
+
+        if self.history_memory is None or self.memory_usage <= self.history_memory:
+            return
+
+        panes = sorted(self.panes, key=lambda pane: (
+            pane is self.pane, -pane.memory_usage * (now - pane.last_output + 1)))
+
+        for pane in panes:
+            excess = self.memory_usage - self.history_memory
+            if excess <= 0:
+                break
+
+            freed = pane.console.trim_history(excess)
+            pane.memory_usage -= freed
+            self.memory_usage -= freed
+
+            if freed:
+                log.info('evicted %d bytes of history from window %d', freed, pane.id)
+
+    def check_silence(self):
+        now = time.monotonic()
+
+        for pane in self.panes:
+            if pane.monitor and pane.monitor.check_silence(now):
+                self.raise_alert(pane, 'silence')
+
+    def raise_alert(self, pane, reason, pattern=None):
+        '''Flag a window in the banner, unless it is the current one'''
+        if pane is self.pane:
+            return
+
+        window = self.panes.index(pane)
+        pane.flags.add(self.alert_flags[reason])
+        log.info('alert in window %d: %s %s', window, reason, pattern or '')
+
+        if reason != 'activity':
+            message = 'window %d: %s' % (window, pattern or reason)
+            self.alert = time.monotonic(), message
+
+        if self.control:
+            self.control.emit('alert', window=window, reason=reason, pattern=pattern)
+
+    def memory_status(self):
+        '''Return the memory used by the lines of the panes, for the banner'''
+        usage = '%.1fM' % (self.memory_usage / 1e6)
+
+        if self.history_memory is not None:
+            usage += '/%gM' % round(self.history_memory / 1e6, 1)
+
+        return usage
+
+    def pane_output(self, pane, data):
+        '''Called with the output of the process of a pane'''
+        if pane.monitor:
+            for pattern in pane.monitor.feed(data):
+                self.raise_alert(pane, 'pattern', pattern)
+
+        if self.monitor_activity and self.alert_flags['activity'] not in pane.flags:
+            self.raise_alert(pane, 'activity')
+
+        if self.control:
+            self.control.output(pane, data)
+
+        if self.recorder:
+            self.recorder.output(pane.id, data)
+
+    def toggle_pipe(self):
+        '''Start or stop streaming the output of the current window'''
+        if self.pane.pipe:
+            self.pane.stop_pipe()
+        else:
+            target, strip, policy = self.pipe_options
+
+            try:
+                self.pane.start_pipe(target.format(window=self.current), strip, policy)
+            except OSError as e:
+                log.error('unable to pipe the window: %s', e)
+
+    def export_pane(self):
+        '''Write the history of the current window into a file, in a thread'''
+        path = os.path.expanduser(EXPORT_TARGET.format(window=self.current))
+        lines = self.console.snapshot_lines()
+
+        def run():
+            try:
+                export_file(path, *lines())
+            except OSError as e:
+                log.error('unable to export the window: %s', e)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def copy_last_output(self):
+        '''Copy the output of the last command of the current window
+
+        The text goes into the paste buffer, and into the clipboard of the
+        terminal with OSC 52.
+        '''
+        lines = self.console.last_output()
+        if not lines:
+            self.alert = time.monotonic(), 'no command output'
+            return
+
+        self.paste_buffer = ''.join(export(lines, self.console.width)).encode('utf8')
+        os.write(sys.stdout.fileno(), b'\x1b]52;c;%s\x07' % base64.b64encode(self.paste_buffer))
+        self.alert = time.monotonic(), 'copied %d lines' % self.paste_buffer.count(b'\n')
+
+    def paste_buffer_input(self):
+        '''Send the paste buffer to the window, like a paste from the terminal'''
+        if self.paste_buffer:
+            self.start_paste()
+            self.write_paste(self.paste_buffer)
+            self.end_paste()
 
     def refresh(self):
-        self.screen.leaveok(1)
-        self.screen.refresh()
-        self.screen.leaveok(0)
+        start = time.perf_counter()
+
+        if self.renderer:
+            self.render()
+        else:
+            self.screen.leaveok(1)
+            self.screen.refresh()
+            self.screen.leaveok(0)
+
+            self.banner.refresh()
+            self.console.refresh()
+
+        self.pane.refresh_time.observe(time.perf_counter() - start)
+
+    def render(self):
+        '''Draw the screen with the ANSI renderer'''
+        if self.console.synchronized_update():
+            return
 
-        self.banner.refresh()
-        self.console.refresh()
+        self.banner.update()
+        self.renderer.render(self.console.display_lines() + [self.banner.display_line()],
+                             self.console.display_cursor())
+        self.banner.redraw = False
 
     def resize(self):
         height, width = get_hw(sys.stdout)
+
+        if self.recorder:
+            self.recorder.record('SIZE', height, width)
         curses.resizeterm(height, width)
         curses.update_lines_cols()
 
         self.screen.resize(height, width)
         self.banner.resize(1, width, height - 1, 0)
-        self.console.resize(height - 1, width, 0, 0)
 
-        set_hw(self.proc.stdout, self.console.height, self.console.width)
-        self.proc.send_signal(signal.SIGWINCH)
+        for pane in self.panes:
+            pane.resize(height - 1, width, 0, 0)
 
         self.resize_event = False
 
-        self.screen.clear()
+        if self.renderer:
+            self.renderer.invalidate()
+        else:
+            self.screen.clear()
+
         self.refresh()
 
     def get_key(self):
         fd = sys.stdin.fileno()
 
         if can_read(fd):
-            return os.read(fd, 1024)
+            return os.read(fd, 65536)
         elif self.int_event:
             self.int_event = False
             return bytes([termios.CINTR])
         else:
             return None
 
+    def wait(self, timeout):
+        '''Wait for a key, an output of a process or the timeout'''
+        rlist = [sys.stdin.fileno()]
+        wlist = []
+
+        if self.control:
+            rlist.append(self.control.fileno())
+
+        for pane in self.panes:
+            rlist.extend(pane.fds())
+
+            if pane.proc.pending_write:
+                wlist.append(pane.proc.fd)
+
+            if pane.has_backlog():
+                timeout = 0
+
+        select.select(rlist, wlist, [], timeout)
+
     def sigwinch(self, *args):
         self.resize_event = True
+        self.record_signal('WINCH')
 
     def sigcont(self, *args):
         self.resize_event = True
+        self.record_signal('CONT')
 
     def sigint(self, *args):
         self.int_event = True
+        self.record_signal('INT')
+
+    def sigusr2(self, *args):
+        self.upgrade_event = True
+        self.record_signal('USR2')
+
+    def record_signal(self, name):
+        # the file is written by the main loop, outside of the handler
+        if self.recorder:
+            self.signals.append(name)
+
+    def input_panes(self):
+        '''Return the panes receiving the input: all the synchronized panes
+        if the current one is synchronized, the current one first
+        '''
+        if not self.pane.synchronized:
+            return [self.pane]
+
+        return [self.pane] + [pane for pane in self.panes
+                              if pane.synchronized and pane is not self.pane]
+
+    def write_input(self, data):
+        '''Queue the input for the processes, a slow process does not delay the others'''
+        for pane in self.input_panes():
+            pane.proc.write(data)
+
+    def handle_key(self, key):
+        if not self.console.auto_scroll: # currently scrolling
+            self.handle_scroll_key(key)
+        elif key[:1] == b'\x02':
+            self.console_key = True
+
+            if len(key) > 1: # the prefix and the key were read at once
+                self.handle_key(key[1:])
+                return
+        elif self.console_key:
+            self.console_key = False
+            self.handle_prefix_key(key)
+        else:
+            self.write_input(key)
+            return # the screen is updated by the output of the process
+
+        self.refresh()
+
+    def handle_input(self, data):
+        '''Dispatch the data read on the terminal between keys and pastes
+
+        Pastes are delimited by the bracketed paste markers of the terminal.
+        Without these, a large read is also considered as a paste.
+        '''
+        while data:
+            if self.paste is None:
+                start = data.find(PASTE_START)
+
+                if start < 0:
+                    if len(data) >= PASTE_MIN_SIZE and not data.startswith(b'\x1b'):
+                        self.start_paste()
+                        self.write_paste(data)
+                        self.end_paste()
+                    else:
+                        self.handle_key(data)
+                    return
+
+                if start > 0:
+                    self.handle_key(data[:start])
+
+                self.start_paste()
+                data = data[start + len(PASTE_START):]
+            else:
+                data = self.paste + data
+                end = data.find(PASTE_END)
+
+                if end < 0:
+                    # keep what could be the beginning of the end marker
+                    keep = next((i for i in range(len(PASTE_END) - 1, 0, -1)
+                                 if data.endswith(PASTE_END[:i])), 0)
+                    self.paste = data[len(data) - keep:]
+                    self.write_paste(data[:len(data) - keep])
+                    return
+
+                self.write_paste(data[:end])
+                self.end_paste()
+                data = data[end + len(PASTE_END):]
+
+    def start_paste(self):
+        self.paste = b''
+        self.console_key = False
+
+        if not self.console.auto_scroll:
+            self.console.disable_scroll()
+            self.refresh()
+
+        for pane in self.input_panes():
+            if pane.console.bracketed_paste:
+                pane.proc.write(PASTE_START)
+
+    def write_paste(self, data):
+        # the pasted data is queued and delivered while the main loop runs
+        self.write_input(data.replace(PASTE_END, b''))
+
+    def end_paste(self):
+        self.paste = None
+
+        for pane in self.input_panes():
+            if pane.console.bracketed_paste:
+                pane.proc.write(PASTE_END)
+
+    def handle_prefix_key(self, key):
+        if key == b'\x02':
+            self.write_input(key)
+        elif key == b'c':
+            self.new_pane()
+        elif key == b'n':
+            self.select_pane((self.current + 1) % len(self.panes))
+        elif key == b'p':
+            self.select_pane((self.current - 1) % len(self.panes))
+        elif key.isdigit() and int(key) < len(self.panes):
+            self.select_pane(int(key))
+        elif key == b'P':
+            self.toggle_pipe()
+        elif key == b'E':
+            self.export_pane()
+        elif key == b'U':
+            self.upgrade_event = True
+        elif key == b'S':
+            self.pane.synchronized = not self.pane.synchronized
+        elif key == b']':
+            self.paste_buffer_input()
+        else:
+            self.handle_scroll_key(key)
 
     def handle_scroll_key(self, key):
         if key in (b'\x03', b'\r', b'\n'):
@@ -1133,78 +4259,208 @@ class ScreenManager:
             self.console.scroll(-1)
         elif key in (b'\x1b[B', b'\x1bOB'):
             self.console.scroll(1)
+        elif key == b'{':
+            self.console.scroll_to_prompt(-1)
+        elif key == b'}':
+            self.console.scroll_to_prompt(1)
+        elif key == b'y':
+            self.copy_last_output()
 
     def main_loop(self):
         old_sigwinch = signal.signal(signal.SIGWINCH, self.sigwinch) # window resized
         old_sigcont = signal.signal(signal.SIGCONT, self.sigcont) # redraw after being suspended
         old_sigint = signal.signal(signal.SIGINT, self.sigint) # Ctrl-C
+        old_sigusr2 = signal.signal(signal.SIGUSR2, self.sigusr2) # upgrade
 
-        self.proc = Process(os.environ.get('SHELL', '/bin/sh'))
-        self.console.reply_query = lambda s: self.proc.stdin.write(s.encode('utf8'))
-        set_hw(self.proc.stdout, self.console.height, self.console.width)
-        self.proc.send_signal(signal.SIGWINCH)
+        # ask the terminal to delimit pastes
+        os.write(sys.stdout.fileno(), b'\x1b[?2004h')
 
         try:
-            self.refresh()
+            if self.recorder:
+                self.recorder.record('SIZE', *get_hw(sys.stdout))
+
+            self.restore_panes()
+
+            while self.panes:
+                start = time.perf_counter()
+
+                if self.recorder:
+                    while self.signals:
+                        self.recorder.record('SIGNAL', self.signals.popleft())
 
-            while True:
                 key = self.get_key()
                 if key:
-                    if not self.console.auto_scroll: # currently scrolling
-                        self.handle_scroll_key(key)
-                    elif key == b'\x02':
-                        self.console_key = True
-                    elif self.console_key:
-                        self.console_key = False
-                        self.handle_scroll_key(key)
-                    else:
-                        self.proc.stdin.write(key)
+                    if self.recorder:
+                        self.recorder.input(key)
 
-                    self.refresh()
+                    self.handle_input(key)
+
+                if self.control:
+                    self.control.process()
 
                 if self.resize_event:
                     self.resize()
 
-                if self.proc.poll() is not None:
-                    break
+                if self.upgrade_event:
+                    self.upgrade_event = False
+                    self.upgrade()
 
-                if can_read(self.proc.stdout):
-                    try:
-                        self.console.write(self.proc.stdout.read(4096))
-                    except OSError:
-                        pass
+                if self.banner.update():
                     self.refresh()
 
-                if can_read(self.proc.stderr):
-                    try:
-                        self.console.write(self.proc.stderr.read(4096))
-                    except OSError:
-                        pass
-                    self.refresh()
+                for pane in list(self.panes):
+                    if pane.proc.poll() is not None:
+                        self.remove_pane(pane)
+                        continue
 
-                curses.napms(5)
+                    if pane.read() and pane is self.pane:
+                        self.refresh()
+
+                    pane.proc.flush()
+
+                if time.monotonic() - self.memory_time > self.memory_interval:
+                    self.check_memory()
+                    self.check_silence()
+                    self.reap_orphans()
+
+                if self.snapshot and time.monotonic() - self.snapshot.last_time > self.snapshot.interval:
+                    self.snapshot.save(self.panes)
+
+                if self.metrics and time.monotonic() - self.metrics.last_time > self.metrics.interval:
+                    self.metrics.update(self)
+
+                if self.recorder:
+                    self.recorder.flush()
+
+                self.loop_time.observe(time.perf_counter() - start)
+                self.wait(0.005)
         finally:
             signal.signal(signal.SIGWINCH, old_sigwinch)
             signal.signal(signal.SIGCONT, old_sigcont)
             signal.signal(signal.SIGINT, old_sigint)
+            signal.signal(signal.SIGUSR2, old_sigusr2)
+            os.write(sys.stdout.fileno(), b'\x1b[?2004l')
+            self.banner.close()
+
+            if self.renderer:
+                self.renderer.close()
+
+            if self.control:
+                self.control.close()
 
-            if self.proc.poll() is None:
-                self.proc.kill()
+            if self.recorder:
+                self.recorder.close()
 
+            if self.metrics:
+                self.metrics.close()
 
-def main(screen):
+            if self.snapshot:
+                self.snapshot.wait()
+                self.snapshot.save(self.panes)
+                self.snapshot.wait()
+
+            for pane in self.panes:
+                pane.close()
+
+
+def main(screen, args):
     curses.use_default_colors()
     screen.keypad(0)
     screen.nodelay(1)
 
-    screen_manager = ScreenManager(screen)
+    screen_manager = ScreenManager(screen,
+                                   workers=args.workers,
+                                   snapshot_dir=args.snapshot_dir,
+                                   pipe_target=args.pipe_pane,
+                                   pipe_strip=args.pipe_strip,
+                                   pipe_policy=args.pipe_policy,
+                                   renderer=args.renderer,
+                                   control_socket=args.control_socket,
+                                   record=args.record,
+                                   history_memory=args.history_memory * 1e6 or None,
+                                   monitor_activity=args.monitor_activity,
+                                   monitor_silence=args.monitor_silence,
+                                   monitor_patterns=args.monitor_pattern or (),
+                                   metrics_file=args.metrics_file,
+                                   metrics_socket=args.metrics_socket,
+                                   resume=args.resume)
     screen_manager.main_loop()
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='A simple tmux clone')
+    parser.add_argument('--workers',
+                        help='Run the emulation of each pane in a worker process',
+                        action='store_true')
+    parser.add_argument('--snapshot-dir',
+                        help='Save the windows in that directory periodically and on exit, '
+                             'and restore them on startup')
+    parser.add_argument('--pipe-pane',
+                        help='File where the output of the window is streamed with prefix P, '
+                             'or shell command if it starts with | (default: %s)' % PIPE_TARGET,
+                        default=PIPE_TARGET)
+    parser.add_argument('--pipe-strip',
+                        help='Remove the escape sequences from the streamed output',
+                        action='store_true')
+    parser.add_argument('--pipe-policy',
+                        help='Drop the output or block when the pipe is too slow (default: drop)',
+                        choices=('drop', 'block'),
+                        default='drop')
+    parser.add_argument('--renderer',
+                        help='Draw the screen with curses, or with escape sequences written '
+                             'directly to the terminal (default: curses)',
+                        choices=('curses', 'ansi'),
+                        default='curses')
+    parser.add_argument('--control-socket',
+                        help='Serve the control API on that Unix socket')
+    parser.add_argument('--record',
+                        help='Record the input, the output and the resizes of the session '
+                             'into that file')
+    parser.add_argument('--history-memory',
+                        help='Memory used by the history of all the windows, in MB, the history '
+                             'of the idle and large windows is evicted first (default: 64, '
+                             '0 for no limit)',
+                        type=float, default=64)
+    parser.add_argument('--monitor-activity',
+                        help='Flag the windows with new output with # in the status line',
+                        action='store_true')
+    parser.add_argument('--monitor-silence',
+                        help='Flag the windows without output for that many seconds with ~',
+                        type=float)
+    parser.add_argument('--monitor-pattern',
+                        help='Flag the windows whose output matches that regular expression '
+                             'with !, and show the match in the status line (can be repeated)',
+                        action='append')
+    parser.add_argument('--metrics-file',
+                        help='Write metrics of the windows and of the main loop into that file '
+                             'every %d seconds, in the Prometheus text format'
+                             % MetricsExporter.interval)
+    parser.add_argument('--metrics-socket',
+                        help='Serve the metrics on that Unix socket')
+    parser.add_argument('--resume',
+                        help=argparse.SUPPRESS, # descriptor passed on upgrade
+                        type=int)
+
+    args = parser.parse_args()
+
+    for pattern in args.monitor_pattern or ():
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            print('error: invalid pattern %r: %s' % (pattern, e), file=sys.stderr)
+            exit(1)
+
+    try:
+        OutputMonitor(args.monitor_pattern or ())
+    except re.error as e:
+        print('error: invalid patterns: %s' % e, file=sys.stderr)
+        exit(1)
+
     if not sys.stdin.isatty():
         print('error: %s needs to run inside a tty' % sys.argv[0], file=sys.stderr)
         exit(1)
 
+    setup_logging(append=args.resume is not None)
     locale.setlocale(locale.LC_ALL, '')
-    curses.wrapper(main)
+    curses.wrapper(main, args)